@@ -9,209 +9,136 @@ Your task in this exercise has two steps:
     The function takes a string with street name as an argument and should return the fixed name
     We have provided a simple test so that you see what exactly is expected
 """
-import xml.etree.cElementTree as ET
-from collections import defaultdict
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:  # cElementTree was folded into ElementTree (removed in Python 3.9)
+    import xml.etree.ElementTree as ET
+from collections import Counter, defaultdict
+import argparse
+import json
 import re
 import pprint
 
+from compressed import open_input
+from rules import RULES_PATH, load_rules
 
 OSMFILE = "oc.osm"
+AUDIT_PATH = "audit.json"
 street_type = re.compile(r'\b\S+\.?$', re.IGNORECASE)
-zip_type = re.compile(r'^\d{5}(?:[-\s]?\d{4})?$')
+
+LOWER = re.compile(r'^([a-z]|_)*$')
+LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
+                       # r'^([a-z]|_)*:([a-z]|_)*$'
+PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
 
 expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "Square", "Lane", "Road", 
             "Trail", "Parkway", "Commons", "Circle", "Crescent", "Gate", "Terrace", "Grove", "Way"]
 
-nesw_mapping = { 
-            "N.": "North",
-            "N": "North",
-            "E.": "East",
-            "E": "East",
-            "S.": "South",
-            "S": "South",
-            "W.": "West",
-            "W": "West"
-            }
-
-street_mapping = {
-                    "Ave.": "Avenue",
-                    "Aven": "Avenue",
-                    "Ave": "Avenue",
-                    "Blvd.": "Boulevard",
-                    "Blvd": "Boulevard",
-                    "Cir.": "Circle",
-                    "Cir": "Circle",
-                    "Ct.": "Court",
-                    "Ct": "Court",
-                    "Crt.": "Court",
-                    "Crt": "Court",
-                    "Dr.": "Drive",
-                    "Dr": "Drive",
-                    "St.": "Street",
-                    "St": "Street",
-                    "Rd.": "Road",
-                    "Rd": "Road",
-                    "Trl.": "Trail",
-                    "Trl": "Trail"
-                }
+# The street name fixes are the addr:street rules of the rule file process.py cleans with
+# (see rules.py); edit them there
 
-viet_mapping = {
-        '\u00C0' : 'A',
-        '\u00C1' : 'A',
-        '\u00C2' : 'A',
-        '\u00C3' : 'A',
-        '\u00C8' : 'E',
-        '\u00C9' : 'E',
-        '\u00CA' : 'E',
-        '\u00CC' : 'I',
-        '\u00CD' : 'I',
-        '\u00D2' : 'O',
-        '\u00D3' : 'O',
-        '\u00D4' : 'O',
-        '\u00D5' : 'O',
-        '\u00D9' : 'U',
-        '\u00DA' : 'U',
-        '\u00DD' : 'Y',
-        '\u00E0' : 'a',
-        '\u00E1' : 'a',
-        '\u00E2' : 'a',
-        '\u00E3' : 'a',
-        '\u00E8' : 'e',
-        '\u00E9' : 'e',
-        '\u00EA' : 'e',
-        '\u00EC' : 'i',
-        '\u00ED' : 'i',
-        '\u00F2' : 'o',
-        '\u00F3' : 'o',
-        '\u00F4' : 'o',
-        '\u00F5' : 'o',
-        '\u00F9' : 'u',
-        '\u00FA' : 'u',
-        '\u00FD' : 'y',
-        '\u0102' : 'A',
-        '\u0103' : 'a',
-        '\u0110' : 'D',
-        '\u0111' : 'd',
-        '\u0128' : 'I',
-        '\u0129' : 'i',
-        '\u0168' : 'U',
-        '\u0169' : 'u',
-        '\u01A0' : 'O',
-        '\u01A1' : 'o',
-        '\u01AF' : 'U',
-        '\u01B0' : 'u',
-        '\u1EA0' : 'A',
-        '\u1EA1' : 'a',
-        '\u1EA2' : 'A',
-        '\u1EA3' : 'a',
-        '\u1EA4' : 'A',
-        '\u1EA5' : 'a',
-        '\u1EA6' : 'A',
-        '\u1EA7' : 'a',
-        '\u1EA8' : 'A',
-        '\u1EA9' : 'a',
-        '\u1EAA' : 'A',
-        '\u1EAB' : 'a',
-        '\u1EAC' : 'A',
-        '\u1EAD' : 'a',
-        '\u1EAE' : 'A',
-        '\u1EAF' : 'a',
-        '\u1EB0' : 'A',
-        '\u1EB1' : 'a',
-        '\u1EB2' : 'A',
-        '\u1EB3' : 'a',
-        '\u1EB4' : 'A',
-        '\u1EB5' : 'a',
-        '\u1EB6' : 'A',
-        '\u1EB7' : 'a',
-        '\u1EB8' : 'E',
-        '\u1EB9' : 'e',
-        '\u1EBA' : 'E',
-        '\u1EBB' : 'e',
-        '\u1EBC' : 'E',
-        '\u1EBD' : 'e',
-        '\u1EBE' : 'E',
-        '\u1EBF' : 'e',
-        '\u1EC0' : 'E',
-        '\u1EC1' : 'e',
-        '\u1EC2' : 'E',
-        '\u1EC3' : 'e',
-        '\u1EC4' : 'E',
-        '\u1EC5' : 'e',
-        '\u1EC6' : 'E',
-        '\u1EC7' : 'e',
-        '\u1EC8' : 'I',
-        '\u1EC9' : 'i',
-        '\u1ECA' : 'I',
-        '\u1ECB' : 'i',
-        '\u1ECC' : 'O',
-        '\u1ECD' : 'o',
-        '\u1ECE' : 'O',
-        '\u1ECF' : 'o',
-        '\u1ED0' : 'O',
-        '\u1ED1' : 'o',
-        '\u1ED2' : 'O',
-        '\u1ED3' : 'o',
-        '\u1ED4' : 'O',
-        '\u1ED5' : 'o',
-        '\u1ED6' : 'O',
-        '\u1ED7' : 'o',
-        '\u1ED8' : 'O',
-        '\u1ED9' : 'o',
-        '\u1EDA' : 'O',
-        '\u1EDB' : 'o',
-        '\u1EDC' : 'O',
-        '\u1EDD' : 'o',
-        '\u1EDE' : 'O',
-        '\u1EDF' : 'o',
-        '\u1EE0' : 'O',
-        '\u1EE1' : 'o',
-        '\u1EE2' : 'O',
-        '\u1EE3' : 'o',
-        '\u1EE4' : 'U',
-        '\u1EE5' : 'u',
-        '\u1EE6' : 'U',
-        '\u1EE7' : 'u',
-        '\u1EE8' : 'U',
-        '\u1EE9' : 'u',
-        '\u1EEA' : 'U',
-        '\u1EEB' : 'u',
-        '\u1EEC' : 'U',
-        '\u1EED' : 'u',
-        '\u1EEE' : 'U',
-        '\u1EEF' : 'u',
-        '\u1EF0' : 'U',
-        '\u1EF1' : 'u',
-        '\u1EF2' : 'Y',
-        '\u1EF3' : 'y',
-        '\u1EF4' : 'Y',
-        '\u1EF5' : 'y',
-        '\u1EF6' : 'Y',
-        '\u1EF7' : 'y',
-        '\u1EF8' : 'Y',
-        '\u1EF9' : 'y'
-        }
-                   
 
 def audit_street_type(street_types, street_name):
-    m = street_types.search(street_name)
+    m = street_type.search(street_name)
     if m:
-        street_type = m.group()
-        if street_type not in expected:
-            street_types[street_type].add(street_name)
+        found_type = m.group()
+        if found_type not in expected:
+            street_types[found_type].add(street_name)
 
 def audit(osmfile):
-    osm_file = open(osmfile, "r")
-    street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-    osm_file.close()
-    return street_types
+    return audit_map(osmfile).street_names
+
+
+def key_type(key):
+    if LOWER.match(key):
+        return 'lower'
+    elif LOWER_COLON.match(key):
+        return 'lower_colon'
+    elif PROBLEMCHARS.search(key):
+        return 'problemchars'
+    return 'other'
+
+
+class AuditReport(object):
+    """Statistics gathered by audit_map in a single pass over an OSM file
+
+        street_types -- count of every street type found in addr:street values
+        street_names -- unexpected street type -> set of street names using it
+        postcodes -- addr:postcode values that the cleaning rules change or reject -> count
+        phones -- phone values that the cleaning rules change or reject -> count
+        key_types -- 'lower', 'lower_colon', 'problemchars' or 'other' -> count of tag keys
+        users -- user name -> count of nodes, ways and relations last edited by them
+    """
+
+    def __init__(self, ruleset=None):
+        self.ruleset = ruleset if ruleset is not None else load_rules()
+        self.elements = Counter()
+        self.street_types = Counter()
+        self.street_names = defaultdict(set)
+        self.postcodes = Counter()
+        self.phones = Counter()
+        self.key_types = Counter()
+        self.users = Counter()
+
+    def add_element(self, elem):
+        self.elements[elem.tag] += 1
+        if 'user' in elem.attrib:
+            self.users[elem.attrib['user']] += 1
+        for tag in elem.iter('tag'):
+            self.add_tag(tag)
+
+    def add_tag(self, tag):
+        self.key_types[key_type(tag.attrib['k'])] += 1
+        value = tag.attrib['v']
+        if is_street_name(tag):
+            m = street_type.search(value)
+            if m:
+                self.street_types[m.group()] += 1
+                if m.group() not in expected:
+                    self.street_names[m.group()].add(value)
+        elif is_zip(tag):
+            if self.changed(tag.attrib['k'], value):
+                self.postcodes[value] += 1
+        elif is_phone(tag):
+            if self.changed(tag.attrib['k'], value):
+                self.phones[value] += 1
+
+    def changed(self, k, value):
+        """whether the rules for k (if any) change or reject value"""
+        return k in self.ruleset and self.ruleset.clean(k, value)[0] != value
+
+    def to_dict(self):
+        return {'elements': dict(self.elements),
+                'street_types': dict(self.street_types.most_common()),
+                'street_names': {k: sorted(v) for k, v in sorted(self.street_names.items())},
+                'postcodes': dict(self.postcodes.most_common()),
+                'phones': dict(self.phones.most_common()),
+                'key_types': dict(self.key_types),
+                'users': dict(self.users.most_common())}
+
+
+def audit_map(osmfile, tags=('node', 'way', 'relation'), rules_path=RULES_PATH):
+    """audit every top level element of osmfile in one streaming pass, clearing each
+    element once it is counted so memory stays flat whatever the size of the file;
+    postcodes and phones are checked against the rules of rules_path (see rules.py)
+    """
+    report = AuditReport(load_rules(rules_path))
+    with open_input(osmfile) as source:
+        context = ET.iterparse(source, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag in tags:
+                report.add_element(elem)
+                root.clear()
+    return report
+
+
+def write_report(osmfile, report_path=AUDIT_PATH, rules_path=RULES_PATH):
+    report = audit_map(osmfile, rules_path=rules_path)
+    with open(report_path, 'w', encoding='utf-8') as report_file:
+        json.dump(report.to_dict(), report_file, indent=2, ensure_ascii=False)
+    return report
 
 
 def is_street_name(elem):
@@ -224,59 +151,11 @@ def is_zip(elem):
     return (elem.attrib['k'] == "addr:postcode")
 
 
-def substitute(name, mapping):
-    """Replaces characters in a string as defined by the given dictionary mapping"""
-    
-    subbed_name = name
-    for key in mapping.keys():
-        if key in name:
-            subbed_name = re.sub(key, mapping[key], subbed_name)
-    return subbed_name
-
-def update_zip(zip):
-    """standardizes zip code to xxxxx or xxxxx-xxxx"""
-    
-    if zip.lower() == 'disneyland':
-        return '92802'
-    noletters = re.sub(r'^\D*|[a-zA-Z]|^D*$', '', zip)
-    if zip_type.match(noletters):
-        numbers = re.sub(r'\D', '', noletters)
-        if len(numbers) == 5:
-            return numbers
-        elif len(numbers) == 9:
-            numbers = numbers[:5] + '-' + numbers[5:]
-            return numbers
-    else:
-        return None
-
-
-def update_phone(number):
-    """standardize phone number to 10 consecutive digits"""
-    
-    digits = re.sub(r'[^0-9]', '', number)
-    if re.match(r'^1\d{10}$', digits):
-        digits = digits[1:]
-    if re.match(r'\d{10}$', digits):
-        return digits
-    else:
-        return None
-
-
-def update_name(name):
-    """cleans street name"""
-
-    # standardize Vietnamese names
-    better_name = substitute(name, viet_mapping)
-   
-    # spell out abbreviated directions if they're found in the beginning or middle of the name
-    for key in nesw_mapping.keys():
-        better_name = re.sub (r'\s' + re.escape(key) + r'\s', ' ' + nesw_mapping[key] + ' ', better_name, flags=re.I)
-        better_name = re.sub (r'^' + re.escape(key) + r'\s', nesw_mapping[key] + ' ', better_name, flags=re.I)
-    
-    # spell out abbreviated names at the end of name
-    for key in street_mapping.keys():
-        better_name = re.sub(r'\s' + re.escape(key) + r'$', ' ' + street_mapping[key], better_name, flags=re.I)
-
-    return better_name
-    
-
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Audit an OSM XML file and write a JSON report')
+    parser.add_argument('osm_file', nargs='?', default=OSMFILE)
+    parser.add_argument('--report', default=AUDIT_PATH, help='output report (default: %(default)s)')
+    parser.add_argument('--rules', default=RULES_PATH,
+                        help='rule file postcodes and phones are checked against (default: %(default)s)')
+    args = parser.parse_args()
+    pprint.pprint(dict(write_report(args.osm_file, args.report, args.rules).street_names))
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Throughput and memory benchmark for the wrangling pipeline.
+
+Synthetic OSM files are generated at each requested size (number of nodes,
+with one way per ways_ratio nodes) with a configurable number of tags per
+element and share of Vietnamese and abbreviated street names. On each file
+the stages below are timed, every one in a fresh child process so that its
+peak RSS is its own:
+
+- get_element: parsing only
+- shape_element: parsing + shape_rows with a throwaway change log
+- update_name / update_phone / update_zip: the cached cleaners load_tag uses
+  (process.CLEANERS) over every value of their key in the file, caches
+  cleared first
+- process_map: the full conversion to csv(s) in a scratch directory
+- process_map.gz, ...: the same from a copy of the file compressed with each
+  of --compressions (decompressed in a background thread)
+- write_csv.gz, ...: the conversion of the plain file to compressed csv(s)
+
+Results (elements/s and peak RSS per stage and size) are printed and saved as
+JSON; --compare prints the speedup of this run over an earlier result file:
+
+    python benchmark.py --sizes 10000 100000 --output before.json
+    python benchmark.py --sizes 10000 100000 --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+try:
+    import resource
+except ImportError:  # not available on Windows, peak RSS is reported as None
+    resource = None
+
+import compressed
+import process
+from parsers import DEFAULT_BACKEND, NullWriter
+
+RESULTS_PATH = "benchmark.json"
+SIZES = (10000, 100000)
+WAYS_RATIO = 5
+TAGS_PER_ELEMENT = 2.0
+VIET_SHARE = 0.1
+ABBREV_SHARE = 0.5
+
+street_bases = ["Main", "Chapman", "Katella", "Euclid", "Harbor", "Beach", "Brookhurst", "Magnolia",
+                "Bolsa", "Westminster", "Trabuco", "Lincoln", "Orangethorpe", "Tustin", "Yorba Linda"]
+viet_bases = ["Phở Hòa", "Nguyễn Trãi", "Lê Lợi", "Đường Bolsa", "Hùng Vương", "Trần Hưng Đạo"]
+full_suffixes = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Road", "Trail", "Way", "Lane"]
+abbrev_suffixes = ["St", "St.", "Ave", "Ave.", "Blvd", "Blvd.", "Dr", "Ct", "Rd", "Trl", "Cir"]
+abbrev_directions = ["N", "N.", "E", "E.", "S", "S.", "W", "W.", ""]
+phones = ["(714) 555-{0:04d}", "+1 949 555 {0:04d}", "714.555.{0:04d}", "1-562-555-{0:04d}", "555-{0:04d}"]
+postcodes = ["9{0:04d}", "CA 9{0:04d}", "9{0:04d}-1234", "9{0:04d}1234", "Disneyland"]
+other_tags = [("amenity", ["cafe", "school", "fuel", "restaurant", "bank"]),
+              ("building", ["yes", "house", "retail"]),
+              ("name", ["Shelly's Tasty Freeze", "Orange County Library", "Pho 79"]),
+              ("tiger:county", ["Orange, CA"]),
+              ("source", ["bing", "survey"])]
+
+
+def street_name(rng, viet_share, abbrev_share):
+    base = rng.choice(viet_bases if rng.random() < viet_share else street_bases)
+    if rng.random() < abbrev_share:
+        direction = rng.choice(abbrev_directions)
+        name = (direction + ' ' if direction else '') + base + ' ' + rng.choice(abbrev_suffixes)
+    else:
+        name = base + ' ' + rng.choice(full_suffixes)
+    return name
+
+
+def random_tags(rng, density, viet_share, abbrev_share):
+    count = int(density) + (rng.random() < density - int(density))
+    tags = []
+    for _ in range(count):
+        r = rng.random()
+        if r < 0.3:
+            tags.append(('addr:street', street_name(rng, viet_share, abbrev_share)))
+        elif r < 0.4:
+            tags.append(('phone', rng.choice(phones).format(rng.randrange(10000))))
+        elif r < 0.5:
+            tags.append(('addr:postcode', rng.choice(postcodes).format(rng.randrange(2000, 3000))))
+        else:
+            k, values = rng.choice(other_tags)
+            tags.append((k, rng.choice(values)))
+    return tags
+
+
+def escape(value):
+    return (value.replace('&', '&amp;').replace('<', '&lt;')
+                 .replace('>', '&gt;').replace('"', '&quot;'))
+
+
+def write_synthetic_osm(path, nodes, ways_ratio=WAYS_RATIO, density=TAGS_PER_ELEMENT,
+                        viet_share=VIET_SHARE, abbrev_share=ABBREV_SHARE, seed=0):
+    """write an OSM file with nodes nodes and nodes // ways_ratio ways, each with on
+    average density tags; returns the number of top level elements written
+    """
+    rng = random.Random(seed)
+    users = ['user{0}'.format(i) for i in range(200)]
+
+    def attrs(element_id):
+        uid = rng.randrange(len(users))
+        return 'id="{0}" version="{1}" timestamp="2017-{2:02d}-{3:02d}T12:00:00Z" changeset="{4}" ' \
+               'uid="{5}" user="{6}"'.format(element_id, rng.randint(1, 9), rng.randint(1, 12),
+                                             rng.randint(1, 28), rng.randrange(10 ** 8), uid, users[uid])
+
+    def tag_lines(tags):
+        return ''.join('\n  <tag k="{0}" v="{1}"/>'.format(k, escape(v)) for k, v in tags)
+
+    with open(path, 'w', encoding='utf-8') as osm:
+        osm.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="benchmark.py">\n')
+        node_ids = list(range(1, nodes + 1))
+        for node_id in node_ids:
+            tags = random_tags(rng, density, viet_share, abbrev_share)
+            lat, lon = rng.uniform(33.3, 33.9), rng.uniform(-118.1, -117.4)
+            if tags:
+                osm.write(' <node {0} lat="{1:.7f}" lon="{2:.7f}">{3}\n </node>\n'.format(
+                    attrs(node_id), lat, lon, tag_lines(tags)))
+            else:
+                osm.write(' <node {0} lat="{1:.7f}" lon="{2:.7f}"/>\n'.format(attrs(node_id), lat, lon))
+        ways = nodes // ways_ratio
+        for way_id in range(nodes + 1, nodes + ways + 1):
+            nds = ''.join('\n  <nd ref="{0}"/>'.format(rng.choice(node_ids))
+                          for _ in range(rng.randint(2, 20)))
+            osm.write(' <way {0}>{1}{2}\n </way>\n'.format(
+                attrs(way_id), nds, tag_lines(random_tags(rng, density, viet_share, abbrev_share))))
+        osm.write('</osm>\n')
+    return nodes + ways
+
+
+def run_get_element(osm_file, backend):
+    return sum(1 for _ in process.get_element(osm_file, ('node', 'way'), backend))
+
+
+def run_shape_element(osm_file, backend):
+    logger = NullWriter()
+    count = 0
+    for element in process.get_element(osm_file, ('node', 'way'), backend):
+        process.shape_rows(element, logger)
+        count += 1
+    return count
+
+
+def tag_values(osm_file, k):
+    return [tag.attrib['v'] for element in process.get_element(osm_file, ('node', 'way'))
+            for tag in element.iter('tag') if tag.attrib['k'] == k]
+
+
+def run_cleaner(osm_file, k):
+    values = tag_values(osm_file, k)
+    cleaner = process.CLEANERS[k]
+    cleaner.cache_clear()
+    start = time.perf_counter()
+    for value in values:
+        cleaner(value)
+    # only the cleaning itself is timed, not collecting the values
+    return len(values), time.perf_counter() - start
+
+
+def run_process_map(osm_file, backend, workers=1, compression=None):
+    scratch = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(scratch)
+    try:
+        start = time.perf_counter()
+        process.process_map(osm_file, workers=workers, backend=backend, compression=compression)
+        elapsed = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+    return run_get_element(osm_file, backend), elapsed
+
+
+def run_compressed_input(osm_file, backend, compression):
+    """process_map of the copy of osm_file compressed with compression"""
+    return run_process_map(osm_file + compressed.EXTENSIONS[compression], backend)
+
+
+def compress_copy(osm_file, compression):
+    with open(osm_file, 'rb') as plain, \
+         compressed.open_binary(osm_file + compressed.EXTENSIONS[compression], compression, 'wb') as out:
+        shutil.copyfileobj(plain, out, compressed.READ_SIZE)
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    # include finished pool workers, e.g. of process_map with workers > 1
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kB on Linux but in bytes on macOS
+    return peak // 1024 if platform.system() == 'Darwin' else peak
+
+
+def child(queue, func, args):
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    count, elapsed = result if isinstance(result, tuple) else (result, elapsed)
+    queue.put((count, elapsed, peak_rss_kb()))
+
+
+def measure(func, *args):
+    """run func(*args) in a fresh process; returns (elements, seconds, peak RSS in kB)
+
+    func returns the number of elements it handled, or (elements, seconds) to
+    report its own timing
+    """
+    queue = multiprocessing.Queue()
+    worker = multiprocessing.Process(target=child, args=(queue, func, args))
+    worker.start()
+    result = queue.get()
+    worker.join()
+    return result
+
+
+def stages(backend=DEFAULT_BACKEND, workers=1, compressions=()):
+    """(name, func, extra args) of every benchmarked stage"""
+    return ([('get_element', run_get_element, (backend,)),
+             ('shape_element', run_shape_element, (backend,)),
+             ('update_name', run_cleaner, ('addr:street',)),
+             ('update_phone', run_cleaner, ('phone',)),
+             ('update_zip', run_cleaner, ('addr:postcode',)),
+             ('process_map', run_process_map, (backend, workers))] +
+            [('process_map' + compressed.EXTENSIONS[c], run_compressed_input, (backend, c))
+             for c in compressions] +
+            [('write_csv' + compressed.EXTENSIONS[c], run_process_map, (backend, workers, c))
+             for c in compressions])
+
+
+def run_benchmark(sizes=SIZES, backend=DEFAULT_BACKEND, workers=1, density=TAGS_PER_ELEMENT,
+                  viet_share=VIET_SHARE, abbrev_share=ABBREV_SHARE, seed=0, compressions=()):
+    results = []
+    scratch = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            osm_file = os.path.join(scratch, 'synthetic-{0}.osm'.format(size))
+            write_synthetic_osm(osm_file, size, density=density, viet_share=viet_share,
+                                abbrev_share=abbrev_share, seed=seed)
+            file_size = os.path.getsize(osm_file)
+            for compression in compressions:
+                compress_copy(osm_file, compression)
+            for name, func, args in stages(backend, workers, compressions):
+                count, seconds, rss = measure(func, osm_file, *args)
+                result = {'size': size, 'file_bytes': file_size, 'stage': name, 'elements': count,
+                          'seconds': seconds, 'elements_per_sec': count / seconds if seconds else None,
+                          'peak_rss_kb': rss}
+                print('{size:9d} {stage:14} {elements:9d} elements {seconds:8.3f} s '
+                      '{elements_per_sec:12.0f} /s {rss:>10} kB'.format(rss=str(rss), **result))
+                results.append(result)
+            os.remove(osm_file)
+            for compression in compressions:
+                os.remove(osm_file + compressed.EXTENSIONS[compression])
+    finally:
+        shutil.rmtree(scratch)
+    return results
+
+
+def compare(results, baseline):
+    """print the speedup of results over baseline for every (size, stage) in both"""
+    before = {(r['size'], r['stage']): r for r in baseline['results']}
+    for r in results:
+        old = before.get((r['size'], r['stage']))
+        if old and old['elements_per_sec'] and r['elements_per_sec']:
+            print('{0:9d} {1:14} {2:6.2f}x throughput {3:>10} -> {4:>10} kB'.format(
+                r['size'], r['stage'], r['elements_per_sec'] / old['elements_per_sec'],
+                str(old['peak_rss_kb']), str(r['peak_rss_kb'])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the OSM wrangling pipeline')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES),
+                        help='number of nodes of every synthetic file (default: %(default)s)')
+    parser.add_argument('--density', type=float, default=TAGS_PER_ELEMENT,
+                        help='average tags per element (default: %(default)s)')
+    parser.add_argument('--viet-share', type=float, default=VIET_SHARE,
+                        help='share of Vietnamese street names (default: %(default)s)')
+    parser.add_argument('--abbrev-share', type=float, default=ABBREV_SHARE,
+                        help='share of abbreviated street names (default: %(default)s)')
+    parser.add_argument('--parser', default=DEFAULT_BACKEND, help='XML parser backend')
+    parser.add_argument('--workers', type=int, default=1, help='workers for process_map')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compressions', nargs='*', choices=compressed.COMPRESSIONS,
+                        default=[c for c in ('gz', 'bz2', 'xz', 'zst') if compressed.available(c)],
+                        help='compressed input and output to time (default: %(default)s)')
+    parser.add_argument('--output', default=RESULTS_PATH, help='results file (default: %(default)s)')
+    parser.add_argument('--compare', metavar='RESULTS', help='earlier results file to compare with')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sizes, args.parser, args.workers, args.density,
+                            args.viet_share, args.abbrev_share, args.seed, args.compressions)
+    with open(args.output, 'w') as out:
+        json.dump({'params': vars(args), 'python': platform.python_version(),
+                   'platform': platform.platform(), 'results': results}, out, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
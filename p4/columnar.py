@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Write the shaped OSM elements as typed columnar files instead of csv(s):
+Parquet (nodes.parquet, ...) or Arrow IPC streams (nodes.arrows, ...).
+
+Every id is an int64, lat/lon are float64, timestamps are a UTC timestamp
+type and the low cardinality user/key/type columns are dictionary encoded,
+so the files are a fraction of the size of the csv(s) and downstream tools
+can memory-map them and read only the columns they need:
+
+    import pyarrow.parquet as pq
+    nodes = pq.read_table('nodes.parquet', columns=['lat', 'lon'])
+
+    import pyarrow as pa
+    ways_tags = pa.ipc.open_stream(pa.memory_map('ways_tags.arrows')).read_all()
+
+Rows are buffered per table and written as one record batch (a Parquet row
+group) every batch_size rows. Requires pyarrow.
+"""
+
+import argparse
+import codecs
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from process import OSM_PATH, CHANGES_PATH, ChangeLog, ShapedNode, shape_map
+from parsers import BACKENDS, DEFAULT_BACKEND
+from database import TABLES
+
+BATCH_SIZE = 1 << 16
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+STRING_DICT = pa.dictionary(pa.int32(), pa.string())
+
+COLUMN_TYPES = {'id': pa.int64(),
+                'lat': pa.float64(),
+                'lon': pa.float64(),
+                'user': STRING_DICT,
+                'uid': pa.int64(),
+                'version': pa.int64(),
+                'changeset': pa.int64(),
+                'timestamp': pa.timestamp('s', tz='UTC'),
+                'key': STRING_DICT,
+                'value': pa.string(),
+                'type': STRING_DICT,
+                'node_id': pa.int64(),
+                'position': pa.int32()}
+
+SCHEMAS = {table: pa.schema([(f, COLUMN_TYPES[f]) for f in fields]) for table, fields in TABLES}
+
+EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrows'}
+
+
+def to_array(values, arrow_type):
+    """convert a list of shaped values (mostly strings straight from the XML) to arrow_type"""
+    if pa.types.is_dictionary(arrow_type):
+        return pa.array(values, pa.string()).dictionary_encode()
+    if pa.types.is_timestamp(arrow_type):
+        return pc.strptime(pa.array(values, pa.string()), format=TIMESTAMP_FORMAT,
+                           unit=arrow_type.unit).cast(arrow_type)
+    return pa.array(values).cast(arrow_type)
+
+
+class ColumnarSink(object):
+    """Buffer shaped rows per table and write them out as record batches of batch_size rows"""
+
+    def __init__(self, out_dir='.', fmt='parquet', batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.buffers = {table: [] for table, _ in TABLES}
+        self.writers = {}
+        for table, _ in TABLES:
+            path = os.path.join(out_dir, table + EXTENSIONS[fmt])
+            if fmt == 'parquet':
+                self.writers[table] = pq.ParquetWriter(path, SCHEMAS[table])
+            else:
+                self.writers[table] = pa.ipc.new_stream(path, SCHEMAS[table])
+
+    def add(self, table, rows):
+        """Queue rows (tuples in the table's column order) for table"""
+        buf = self.buffers[table]
+        buf.extend(rows)
+        if len(buf) >= self.batch_size:
+            self.flush(table)
+
+    def write(self, el):
+        """Queue every row of one shape_rows result"""
+        if isinstance(el, ShapedNode):
+            self.add('nodes', (el.node,))
+            self.add('nodes_tags', el.node_tags)
+        else:
+            self.add('ways', (el.way,))
+            self.add('ways_nodes', el.way_nodes.rows())
+            self.add('ways_tags', el.way_tags)
+
+    def flush(self, table=None):
+        for name in ([table] if table else self.buffers):
+            rows = self.buffers[name]
+            if rows:
+                schema = SCHEMAS[name]
+                columns = [to_array(list(values), field.type)
+                           for values, field in zip(zip(*rows), schema)]
+                self.writers[name].write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+                del rows[:]
+
+    def close(self):
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
+
+
+def convert_map(file_in, out_dir='.', fmt='parquet', batch_size=BATCH_SIZE, backend=DEFAULT_BACKEND):
+    """ Iteratively process each XML element and write it to columnar files in out_dir,
+        along with the change log
+    """
+
+    sink = ColumnarSink(out_dir, fmt, batch_size)
+    try:
+        with codecs.open(os.path.join(out_dir, CHANGES_PATH), 'w', encoding='utf-8') as changes_file:
+            changes = ChangeLog(changes_file)
+            for el in shape_map(file_in, changes, backend):
+                sink.write(el)
+            changes.close()
+    finally:
+        sink.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert an OSM XML file to Parquet or Arrow files')
+    parser.add_argument('osm_file', nargs='?', default=OSM_PATH)
+    parser.add_argument('--format', default='parquet', choices=sorted(EXTENSIONS),
+                        help='output format (default: %(default)s)')
+    parser.add_argument('--out-dir', default='.', help='output directory (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='rows per record batch (default: %(default)s)')
+    parser.add_argument('--parser', default=DEFAULT_BACKEND, choices=sorted(BACKENDS),
+                        help='XML parser backend (default: %(default)s)')
+    args = parser.parse_args()
+    convert_map(args.osm_file, args.out_dir, args.format, args.batch_size, args.parser)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Transparent compressed input and output for the OSM tools, so a planet
+derived oc.osm.bz2 or oc.osm.gz can be read as is:
+
+    python process.py oc.osm.bz2 --compress gz
+
+open_input opens a plain, gzip, bzip2, xz or zstd file for binary reading,
+going by its magic bytes (or, for a file too short to tell, its extension).
+A compressed file is decompressed READ_SIZE bytes at a time in a background
+thread into a queue of at most QUEUE_DEPTH chunks that the parser reads from;
+zlib, bz2 and lzma release the GIL while they decompress, so decompression
+runs alongside parsing instead of in between.
+
+open_output and open_text open a text file for writing or reading, compressed
+according to the compression given or the file's extension. zstd needs the
+zstandard package.
+"""
+
+import bz2
+import codecs
+import gzip
+import io
+import lzma
+import os
+import queue
+import threading
+try:
+    import zstandard
+except ImportError:  # optional, only needed for .zst files
+    zstandard = None
+
+READ_SIZE = 1 << 20
+QUEUE_DEPTH = 8
+
+MAGIC = [(b'\x1f\x8b', 'gz'),
+         (b'BZh', 'bz2'),
+         (b'\xfd7zXZ\x00', 'xz'),
+         (b'\x28\xb5\x2f\xfd', 'zst')]
+EXTENSIONS = {'gz': '.gz', 'bz2': '.bz2', 'xz': '.xz', 'zst': '.zst'}
+COMPRESSIONS = sorted(EXTENSIONS)
+
+
+def available(compression):
+    return compression != 'zst' or zstandard is not None
+
+
+def from_extension(path):
+    """compression named by path's extension, or None"""
+    for compression, extension in EXTENSIONS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+
+def compression_of(path):
+    """compression of the file at path by its magic bytes, or by its extension if it has too
+    few bytes to tell (or doesn't exist yet); None for a plain file
+    """
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            head = f.read(6)
+        for magic, compression in MAGIC:
+            if head.startswith(magic):
+                return compression
+        if len(head) >= 6:
+            return None
+    return from_extension(path)
+
+
+def open_binary(path, compression, mode='rb'):
+    """binary file object (de)compressing path with compression"""
+    if compression == 'gz':
+        return gzip.open(path, mode, compresslevel=6)
+    if compression == 'bz2':
+        return bz2.open(path, mode)
+    if compression == 'xz':
+        return lzma.open(path, mode)
+    if compression == 'zst':
+        if zstandard is None:
+            raise ImportError('reading or writing {0} needs the zstandard package'.format(path))
+        raw = open(path, mode)
+        if 'r' in mode:
+            return zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True,
+                                                              closefd=True)
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+    raise ValueError('unknown compression {0!r}'.format(compression))
+
+
+class ThreadedReader(object):
+    """File-like object reading stream in a background thread, read_size bytes at a time
+
+    read() hands out the chunks as they come (short reads), which is all the
+    parsers need.
+    """
+
+    def __init__(self, stream, read_size=READ_SIZE, depth=QUEUE_DEPTH):
+        self.stream = stream
+        self.read_size = read_size
+        self.chunks = queue.Queue(depth)
+        self.chunk = memoryview(b'')
+        self.pos = 0
+        self.eof = False
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.fill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fill(self):
+        try:
+            while not self.stop.is_set():
+                data = self.stream.read(self.read_size)
+                self.put(data)
+                if not data:
+                    return
+        except Exception as e:
+            # raised again by read() in the parsing thread
+            self.put(e)
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def next_chunk(self):
+        item = self.chunks.get()
+        if isinstance(item, Exception):
+            self.eof = True
+            raise item
+        if not item:
+            self.eof = True
+        self.chunk, self.pos = memoryview(item), 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self.chunk[self.pos:].tobytes()]
+            while not self.eof:
+                self.next_chunk()
+                parts.append(self.chunk.tobytes())
+            self.pos = len(self.chunk)
+            return b''.join(parts)
+        if self.pos >= len(self.chunk):
+            if self.eof:
+                return b''
+            self.next_chunk()
+        data = self.chunk[self.pos:self.pos + size].tobytes()
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.stop.set()
+        # unblock a fill() waiting on a full queue
+        while self.thread.is_alive():
+            try:
+                self.chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_input(path, threaded=True):
+    """binary file object reading path, decompressed (in a background thread if threaded)
+    if it is compressed
+    """
+    compression = compression_of(path)
+    if compression is None:
+        return open(path, 'rb')
+    stream = open_binary(path, compression, 'rb')
+    return ThreadedReader(stream) if threaded else stream
+
+
+def open_output(path, mode='w', compression=None):
+    """utf-8 text file writing to path, compressed with compression or, by default, as
+    path's extension says; text is written as is (no newline translation)
+    """
+    compression = compression or from_extension(path)
+    if compression is None:
+        return codecs.open(path, mode, encoding='utf-8')
+    return io.TextIOWrapper(open_binary(path, compression, mode + 'b'), encoding='utf-8', newline='')
+
+
+def open_text(path):
+    """utf-8 text file reading path, decompressed if it is compressed"""
+    compression = compression_of(path)
+    if compression is None:
+        return codecs.open(path, 'r', encoding='utf-8')
+    return io.TextIOWrapper(open_binary(path, compression, 'rb'), encoding='utf-8', newline='')
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Load the shaped OSM elements straight into a SQLite database instead of going
+through the intermediate csv(s) and importing them by hand.
+
+Tables follow the csv schema (same column order as NODE_FIELDS, WAY_FIELDS, etc.
+in process.py) so every query in report.md runs unchanged. Rows are inserted
+with executemany in batches inside one large transaction, and the indexes are
+only built once the load is finished, which is much cheaper than maintaining
+them row by row.
+
+A 'tags' view (nodes_tags UNION ALL ways_tags) replaces the subquery that most
+of the report queries rebuild by hand:
+
+sqlite> SELECT tag.type, COUNT(*) as num FROM tags tag
+   ...> GROUP BY tag.type ORDER BY num DESC LIMIT 10;
+"""
+
+import argparse
+import codecs
+import os
+import sqlite3
+
+from process import OSM_PATH, CHANGES_PATH, NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, \
+                    WAY_TAGS_FIELDS, WAY_NODES_FIELDS, ChangeLog, ShapedNode, shape_map
+from parsers import BACKENDS, DEFAULT_BACKEND
+
+DB_PATH = "oc.db"
+BATCH_SIZE = 50000
+
+SCHEMA = """
+CREATE TABLE nodes (
+    id INTEGER PRIMARY KEY NOT NULL,
+    lat REAL,
+    lon REAL,
+    user TEXT,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp TEXT
+);
+
+CREATE TABLE nodes_tags (
+    id INTEGER,
+    key TEXT,
+    value TEXT,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES nodes(id)
+);
+
+CREATE TABLE ways (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user TEXT,
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT
+);
+
+CREATE TABLE ways_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES ways(id)
+);
+
+CREATE TABLE ways_nodes (
+    id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES ways(id),
+    FOREIGN KEY (node_id) REFERENCES nodes(id)
+);
+
+CREATE VIEW tags AS
+    SELECT * FROM nodes_tags
+    UNION ALL
+    SELECT * FROM ways_tags;
+"""
+
+INDEXES = """
+CREATE INDEX nodes_tags_id ON nodes_tags(id);
+CREATE INDEX nodes_tags_key ON nodes_tags(key);
+CREATE INDEX ways_tags_id ON ways_tags(id);
+CREATE INDEX ways_tags_key ON ways_tags(key);
+CREATE INDEX ways_nodes_id ON ways_nodes(id);
+CREATE INDEX ways_nodes_node_id ON ways_nodes(node_id);
+"""
+
+# table name -> column order, matching the csv(s) written by process.py
+TABLES = [('nodes', NODE_FIELDS),
+          ('nodes_tags', NODE_TAGS_FIELDS),
+          ('ways', WAY_FIELDS),
+          ('ways_nodes', WAY_NODES_FIELDS),
+          ('ways_tags', WAY_TAGS_FIELDS)]
+
+
+def insert_statement(table, fields):
+    return 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+        table, ', '.join(fields), ', '.join('?' * len(fields)))
+
+
+class SqliteSink(object):
+    """Buffer shaped rows per table and flush them with executemany every batch_size rows"""
+
+    def __init__(self, conn, batch_size=BATCH_SIZE):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.statements = {table: insert_statement(table, fields) for table, fields in TABLES}
+        self.buffers = {table: [] for table, _ in TABLES}
+
+    def add(self, table, rows):
+        """Queue rows (tuples in the table's column order) for table"""
+        buf = self.buffers[table]
+        buf.extend(rows)
+        if len(buf) >= self.batch_size:
+            self.flush(table)
+
+    def write(self, el):
+        """Queue every row of one shape_rows result"""
+        if isinstance(el, ShapedNode):
+            self.add('nodes', (el.node,))
+            self.add('nodes_tags', el.node_tags)
+        else:
+            self.add('ways', (el.way,))
+            self.add('ways_nodes', el.way_nodes.rows())
+            self.add('ways_tags', el.way_tags)
+
+    def flush(self, table=None):
+        for name in ([table] if table else self.buffers):
+            if self.buffers[name]:
+                self.conn.executemany(self.statements[name], self.buffers[name])
+                del self.buffers[name][:]
+
+
+def create_database(db_path):
+    """Create a fresh database at db_path with the tables and tags view (no indexes yet)"""
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def load_map(file_in, db_path=DB_PATH, batch_size=BATCH_SIZE, backend=DEFAULT_BACKEND):
+    """ Iteratively process each XML element and insert it into a new SQLite database """
+
+    conn = create_database(db_path)
+    # the load is all or nothing, so skip the rollback journal and fsyncs
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    sink = SqliteSink(conn, batch_size)
+
+    with codecs.open(CHANGES_PATH, 'w', encoding='utf-8') as changes_file:
+        changes = ChangeLog(changes_file)
+
+        conn.execute('BEGIN')
+        for el in shape_map(file_in, changes, backend):
+            sink.write(el)
+        sink.flush()
+        conn.commit()
+        changes.close()
+
+    conn.executescript(INDEXES)
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load an OSM XML file into a SQLite database')
+    parser.add_argument('osm_file', nargs='?', default=OSM_PATH)
+    parser.add_argument('--db', default=DB_PATH, help='output database (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='rows per executemany call (default: %(default)s)')
+    parser.add_argument('--parser', default=DEFAULT_BACKEND, choices=sorted(BACKENDS),
+                        help='XML parser backend (default: %(default)s)')
+    args = parser.parse_args()
+    load_map(args.osm_file, args.db, args.batch_size, args.parser)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Node location index, referential integrity check and way geometries, built
+while the OSM file is converted.
+
+Every node is appended to an on-disk index (nodes.idx) of packed
+(id int64, lat float64, lon float64) records sorted by id. Runs of
+RUN_SIZE records are sorted in memory and merged on disk if the input isn't
+already in id order, so the node table never has to fit in RAM. The index is
+memory-mapped and looked up by binary search over its id column.
+
+Nodes come before ways in an OSM file, so the index is complete by the
+first way and from then on every way is checked and measured as it streams:
+- ways_nodes references to missing nodes go to dangling.csv
+  (id, node_id, position)
+- the way's geometry goes to ways_geometry.csv, either its bounding box
+  (id, min_lat, min_lon, max_lat, max_lon) or its WKT line string
+  (id, wkt) with the dangling nodes left out
+
+process.py --geometry bbox|line does this in the conversion pass (the
+parallel mode runs it over the merged csv(s) instead); this module's own
+entry point does it from an earlier conversion's nodes.csv and ways_nodes.csv.
+"""
+
+import argparse
+import bisect
+import codecs
+import csv
+import heapq
+import mmap
+import os
+import shutil
+import struct
+from array import array
+
+import compressed
+
+NODE_INDEX_PATH = "nodes.idx"
+GEOMETRY_PATH = "ways_geometry.csv"
+DANGLING_PATH = "dangling.csv"
+
+NODES_PATH = "nodes.csv"
+WAY_NODES_PATH = "ways_nodes.csv"
+
+RUN_SIZE = 1 << 20
+RECORD = struct.Struct('<qdd')
+
+GEOMETRY_FIELDS = {'bbox': ['id', 'min_lat', 'min_lon', 'max_lat', 'max_lon'],
+                   'line': ['id', 'wkt']}
+DANGLING_FIELDS = ['id', 'node_id', 'position']
+
+
+def pack_records(records):
+    flat = [value for record in records for value in record]
+    return struct.pack('<' + 'qdd' * len(records), *flat)
+
+
+def read_records(path):
+    """Yield the (id, lat, lon) records of an index or run file in order"""
+    with open(path, 'rb') as run:
+        while True:
+            data = run.read(RECORD.size * 4096)
+            if not data:
+                return
+            for record in RECORD.iter_unpack(data):
+                yield record
+
+
+class NodeIndexWriter(object):
+    """Collect (id, lat, lon) records into a sorted index file at path"""
+
+    def __init__(self, path=NODE_INDEX_PATH, run_size=RUN_SIZE):
+        self.path = path
+        self.run_size = run_size
+        self.records = []
+        self.runs = []
+        self.in_order = True
+        self.last_id = None
+
+    def add(self, node_id, lat, lon):
+        node_id = int(node_id)
+        if self.last_id is not None and node_id < self.last_id:
+            self.in_order = False
+        self.last_id = node_id
+        self.records.append((node_id, float(lat), float(lon)))
+        if len(self.records) >= self.run_size:
+            self.write_run()
+
+    def write_run(self):
+        if not self.in_order:
+            self.records.sort()
+        run = '{0}.run{1:04d}'.format(self.path, len(self.runs))
+        with open(run, 'wb') as run_file:
+            run_file.write(pack_records(self.records))
+        self.runs.append(run)
+        self.records = []
+
+    def finish(self):
+        """Write the index file and return it opened as a NodeIndex"""
+        if self.records or not self.runs:
+            self.write_run()
+        with open(self.path, 'wb') as out:
+            if self.in_order:
+                # already sorted end to end, the runs just need concatenating
+                for run in self.runs:
+                    with open(run, 'rb') as run_file:
+                        shutil.copyfileobj(run_file, out)
+            else:
+                batch = []
+                for record in heapq.merge(*[read_records(run) for run in self.runs]):
+                    batch.append(record)
+                    if len(batch) >= 4096:
+                        out.write(pack_records(batch))
+                        batch = []
+                out.write(pack_records(batch))
+        for run in self.runs:
+            os.remove(run)
+        self.runs = []
+        return NodeIndex(self.path)
+
+
+class NodeIndex(object):
+    """Memory-mapped, id sorted (id, lat, lon) records; lookup by binary search"""
+
+    def __init__(self, path=NODE_INDEX_PATH):
+        self.file = open(path, 'rb')
+        self.size = os.path.getsize(path) // RECORD.size
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            # every third int64 is an id, lat and lon are the two float64 after it
+            self.ids = memoryview(self.map).cast('q')[::3]
+            self.values = memoryview(self.map).cast('d')
+        else:
+            self.map = self.ids = self.values = None
+
+    def __len__(self):
+        return self.size
+
+    def lookup(self, node_id):
+        """(lat, lon) of node_id, or None if it isn't in the index"""
+        if not self.size:
+            return None
+        i = bisect.bisect_left(self.ids, node_id)
+        if i < self.size and self.ids[i] == node_id:
+            return self.values[3 * i + 1], self.values[3 * i + 2]
+        return None
+
+    def close(self):
+        if self.map is not None:
+            self.ids.release()
+            self.values.release()
+            self.map.close()
+        self.file.close()
+
+
+class GeometryBuilder(object):
+    """Index nodes, then check and write the geometry of every way, as they stream by
+
+    mode is 'bbox' or 'line' (see GEOMETRY_FIELDS)
+    """
+
+    def __init__(self, mode='bbox', index_path=NODE_INDEX_PATH, geometry_path=GEOMETRY_PATH,
+                 dangling_path=DANGLING_PATH, run_size=RUN_SIZE):
+        self.mode = mode
+        self.index_writer = NodeIndexWriter(index_path, run_size)
+        self.index = None
+        self.geometry_file = codecs.open(geometry_path, 'w', encoding='utf-8')
+        self.dangling_file = codecs.open(dangling_path, 'w', encoding='utf-8')
+        self.geometry_writer = csv.writer(self.geometry_file)
+        self.dangling_writer = csv.writer(self.dangling_file)
+        self.geometry_writer.writerow(GEOMETRY_FIELDS[mode])
+        self.dangling_writer.writerow(DANGLING_FIELDS)
+        self.ways = 0
+        self.dangling = 0
+
+    def add_node(self, node_id, lat, lon):
+        self.index_writer.add(node_id, lat, lon)
+
+    def add_way(self, way_id, node_ids):
+        if self.index is None:
+            self.index = self.index_writer.finish()
+        self.ways += 1
+
+        coords = []
+        for position, node_id in enumerate(node_ids):
+            location = self.index.lookup(node_id)
+            if location is None:
+                self.dangling += 1
+                self.dangling_writer.writerow((way_id, node_id, position))
+            else:
+                coords.append(location)
+        if not coords:
+            return
+
+        if self.mode == 'bbox':
+            lats = [lat for lat, _ in coords]
+            lons = [lon for _, lon in coords]
+            self.geometry_writer.writerow((way_id, min(lats), min(lons), max(lats), max(lons)))
+        else:
+            # WKT puts x (lon) before y (lat)
+            self.geometry_writer.writerow((way_id, 'LINESTRING({0})'.format(
+                ', '.join('{0!r} {1!r}'.format(lon, lat) for lat, lon in coords))))
+
+    def close(self):
+        """Finish the index and outputs; returns (nodes indexed, ways, dangling references)"""
+        if self.index is None:
+            self.index = self.index_writer.finish()
+        self.geometry_file.close()
+        self.dangling_file.close()
+        nodes = len(self.index)
+        self.index.close()
+        return nodes, self.ways, self.dangling
+
+
+def build_from_csv(mode='bbox', nodes_path=NODES_PATH, way_nodes_path=WAY_NODES_PATH, **paths):
+    """ Run a GeometryBuilder over converted (maybe compressed) csv(s); ways_nodes rows of a
+        way are consecutive
+    """
+
+    builder = GeometryBuilder(mode, **paths)
+    with compressed.open_text(nodes_path) as nodes_file:
+        for row in csv.DictReader(nodes_file):
+            builder.add_node(row['id'], row['lat'], row['lon'])
+
+    with compressed.open_text(way_nodes_path) as way_nodes_file:
+        way_id, node_ids = None, array('q')
+        for row in csv.DictReader(way_nodes_file):
+            if row['id'] != way_id:
+                if way_id is not None:
+                    builder.add_way(way_id, node_ids)
+                way_id, node_ids = row['id'], array('q')
+            node_ids.append(int(row['node_id']))
+        if way_id is not None:
+            builder.add_way(way_id, node_ids)
+    return builder.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index node locations of a converted OSM file and '
+                                                 'write way geometries and dangling references')
+    parser.add_argument('--mode', default='bbox', choices=sorted(GEOMETRY_FIELDS),
+                        help='geometry to write per way (default: %(default)s)')
+    parser.add_argument('--nodes', default=NODES_PATH)
+    parser.add_argument('--ways-nodes', default=WAY_NODES_PATH)
+    args = parser.parse_args()
+    nodes, ways, dangling = build_from_csv(args.mode, args.nodes, args.ways_nodes)
+    print('{0} nodes indexed, {1} ways, {2} dangling references'.format(nodes, ways, dangling))
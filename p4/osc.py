@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Apply an OSM change file (.osc) to a database built by database.py, so a map
+update costs time in proportion to the diff instead of the whole region.
+
+An .osc file wraps elements in <create>, <modify> and <delete> blocks:
+
+<osmChange version="0.6">
+  <modify>
+    <node id="757860928" ... lat="41.9747374" lon="-87.6920102">
+      <tag k="amenity" v="fast_food"/>
+    </node>
+  </modify>
+  <delete>
+    <way id="209809850" .../>
+  </delete>
+</osmChange>
+
+Created and modified nodes and ways go through the same shape_rows cleaning as
+a full conversion. Only the rows with the affected ids are replaced
+(nodes/ways) or deleted and re-inserted (their tags and way nodes); deleted
+elements lose all their rows. Relations aren't converted, so they are skipped.
+If query.py's nodes_rtree index has been built, the rows of the affected nodes
+are replaced in it too.
+Compressed change files (e.g. the usual .osc.gz) are read as they are.
+"""
+
+import argparse
+import codecs
+import os
+import sqlite3
+from collections import Counter
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:  # cElementTree was folded into ElementTree (removed in Python 3.9)
+    import xml.etree.ElementTree as ET
+
+from compressed import open_input
+from process import CHANGES_PATH, ChangeLog, shape_rows
+from database import DB_PATH, SqliteSink
+from query import update_rtree
+
+# element -> (main table, tables keyed by the element id)
+ELEMENT_TABLES = {'node': ('nodes', ('nodes_tags',)),
+                  'way': ('ways', ('ways_tags', 'ways_nodes'))}
+
+
+def iter_changes(osc_file):
+    """Yield (action, element) for every element of an .osc file, clearing each one after use"""
+
+    with open_input(osc_file) as source:
+        context = ET.iterparse(source, events=('start', 'end'))
+        _, root = next(context)
+        block = None
+        depth = 0
+        for event, elem in context:
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    block = elem
+                continue
+            if depth == 2:
+                yield block.tag, elem
+                block.clear()
+            elif depth == 1:
+                root.clear()
+            depth -= 1
+
+
+def delete_element(conn, tag, element_id):
+    table, children = ELEMENT_TABLES[tag]
+    conn.execute('DELETE FROM {0} WHERE id = ?'.format(table), (element_id,))
+    for child in children:
+        conn.execute('DELETE FROM {0} WHERE id = ?'.format(child), (element_id,))
+
+
+def apply_changes(osc_file, db_path=DB_PATH, changes_path=CHANGES_PATH):
+    """ Apply every create/modify/delete in osc_file to the database at db_path in one
+        transaction, appending any cleaning to changes_path; returns (action, tag) -> count
+    """
+
+    if not os.path.exists(db_path):
+        raise IOError('no database at {0}, run database.py first'.format(db_path))
+
+    counts = Counter()
+    conn = sqlite3.connect(db_path)
+    sink = SqliteSink(conn)
+    # (tag, id) rows still sitting in the sink's buffers
+    pending = set()
+    # ids of the created, moved and deleted nodes, for the spatial index
+    nodes = set()
+
+    new_log = not os.path.exists(changes_path)
+    with codecs.open(changes_path, 'a', encoding='utf-8') as changes_file:
+        # this diff's changes are counted on their own and appended
+        changes = ChangeLog(changes_file, header=new_log)
+
+        try:
+            for action, element in iter_changes(osc_file):
+                if element.tag not in ELEMENT_TABLES:
+                    continue
+                key = (element.tag, element.attrib['id'])
+                if key in pending:
+                    # a later change to the same element must see its buffered rows
+                    sink.flush()
+                    pending.clear()
+                delete_element(conn, element.tag, element.attrib['id'])
+                if action in ('create', 'modify'):
+                    el = shape_rows(element, changes)
+                    if el:
+                        sink.write(el)
+                        pending.add(key)
+                if element.tag == 'node':
+                    nodes.add(element.attrib['id'])
+                counts[(action, element.tag)] += 1
+            sink.flush()
+            update_rtree(conn, nodes)
+            conn.commit()
+            changes.close()
+        finally:
+            conn.close()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply an OSM change file to a converted database')
+    parser.add_argument('osc_file')
+    parser.add_argument('--db', default=DB_PATH, help='database to update (default: %(default)s)')
+    args = parser.parse_args()
+    for (action, tag), count in sorted(apply_changes(args.osc_file, args.db).items()):
+        print(action, tag, count)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Parser backends for get_element. Every backend yields the top level elements
+of an OSM file whose tag is in tags, one at a time, as something shape_rows
+can read: it only uses .tag, .attrib and .iter().
+
+- etree: xml.etree iterparse (the default, no extra dependency)
+- lxml: lxml.etree.iterparse(tag=...), which only builds events for the
+  requested tags
+- expat: a raw xml.parsers.expat SAX handler that never builds an Element;
+  each element is a small ExpatElement holding its attribute dict and the
+  attribute dicts of its <tag>/<nd> children
+
+A path to a gzip, bzip2, xz or zstd compressed file is decompressed in a
+background thread as it is parsed (see compressed.py).
+
+benchmark() times the backends against each other on the same file, both
+parsing alone and parsing + shape_rows:
+
+    python parsers.py oc.osm
+"""
+
+import argparse
+import time
+import xml.parsers.expat
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:  # cElementTree was folded into ElementTree (removed in Python 3.9)
+    import xml.etree.ElementTree as ET
+
+import compressed
+
+DEFAULT_BACKEND = 'etree'
+READ_SIZE = 1 << 16
+
+
+def etree_elements(osm_file, tags=('node', 'way', 'relation')):
+    """Yield element if it is the right type of tag"""
+
+    context = ET.iterparse(osm_file, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag in tags:
+            yield elem
+            root.clear()
+
+
+def lxml_elements(osm_file, tags=('node', 'way', 'relation')):
+    """Yield element if it is the right type of tag, letting lxml skip every other tag"""
+
+    from lxml import etree
+
+    for _, elem in etree.iterparse(osm_file, events=('end',), tag=tags):
+        yield elem
+        # free the element and the already processed siblings before it
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+class ExpatElement(object):
+    """Just enough of an Element for shape_rows: tag, attrib and iter() over itself and its children"""
+
+    __slots__ = ('tag', 'attrib', 'children')
+
+    def __init__(self, tag, attrib, children):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = children
+
+    def iter(self, tag=None):
+        if tag is None or self.tag == tag:
+            yield self
+        for child in self.children:
+            if tag is None or child.tag == tag:
+                yield child
+
+
+class ExpatHandler(object):
+    """SAX handler collecting the wanted top level elements and their direct children"""
+
+    def __init__(self, tags):
+        self.tags = tags
+        self.depth = 0
+        self.current = None
+        self.ready = []
+
+    def start(self, name, attrs):
+        self.depth += 1
+        if self.depth == 2:
+            self.current = ExpatElement(name, attrs, []) if name in self.tags else None
+        elif self.depth == 3 and self.current is not None:
+            self.current.children.append(ExpatElement(name, attrs, ()))
+
+    def end(self, name):
+        if self.depth == 2 and self.current is not None:
+            self.ready.append(self.current)
+            self.current = None
+        self.depth -= 1
+
+
+def expat_elements(osm_file, tags=('node', 'way', 'relation')):
+    """Yield an ExpatElement for every top level element of the right type of tag"""
+
+    handler = ExpatHandler(tags)
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+
+    source = open(osm_file, 'rb') if isinstance(osm_file, str) else osm_file
+    try:
+        while True:
+            data = source.read(READ_SIZE)
+            parser.Parse(data, not data)
+            for elem in handler.ready:
+                yield elem
+            del handler.ready[:]
+            if not data:
+                break
+    finally:
+        if source is not osm_file:
+            source.close()
+
+
+BACKENDS = {'etree': etree_elements,
+            'lxml': lxml_elements,
+            'expat': expat_elements}
+
+
+def compressed_elements(osm_file, tags, backend):
+    with compressed.open_input(osm_file) as source:
+        for elem in BACKENDS[backend](source, tags):
+            yield elem
+
+
+def get_element(osm_file, tags=('node', 'way', 'relation'), backend=DEFAULT_BACKEND):
+    """Yield element if it is the right type of tag, parsed with the named backend"""
+    if isinstance(osm_file, str) and compressed.compression_of(osm_file):
+        return compressed_elements(osm_file, tags, backend)
+    return BACKENDS[backend](osm_file, tags)
+
+
+class NullWriter(object):
+    def add(self, k, original, new, element_id):
+        pass
+
+
+def benchmark(osm_file, backends=tuple(sorted(BACKENDS)), repeat=3):
+    """best of repeat timings of every backend on osm_file, parsing only and with shape_rows"""
+    from process import shape_rows
+
+    results = {}
+    for backend in backends:
+        for shaped in (False, True):
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                count = 0
+                for elem in get_element(osm_file, ('node', 'way'), backend):
+                    if shaped:
+                        shape_rows(elem, NullWriter())
+                    count += 1
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results[(backend, shaped)] = (count, best)
+            print('{0:6} {1:14} {2:8d} elements {3:8.3f} s {4:10.0f} elements/s'.format(
+                backend, 'parse + shape' if shaped else 'parse', count, best, count / best))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare get_element parser backends')
+    parser.add_argument('osm_file', nargs='?', default='oc.osm')
+    parser.add_argument('--backend', action='append', choices=sorted(BACKENDS),
+                        help='backend to time (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    benchmark(args.osm_file, tuple(args.backend or sorted(BACKENDS)), args.repeat)
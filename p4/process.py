@@ -154,10 +154,24 @@ The final return value for a "way" element should look something like:
                'value': '366409'}]}
 """
 
+import argparse
 import csv
-import codecs
+import json
+import multiprocessing
+import os
+import queue
 import re
-import xml.etree.cElementTree as ET
+import shutil
+import threading
+from array import array
+from collections import namedtuple
+from itertools import repeat
+
+import compressed
+import geometry
+import parsers
+import rules
+from parsers import BACKENDS, DEFAULT_BACKEND
 
 OSM_PATH = "oc.osm"
 
@@ -167,10 +181,9 @@ WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
 CHANGES_PATH = "changes.csv"
+CHECKPOINT_PATH = "process.checkpoint"
 
-LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
-                       # r'^([a-z]|_)*:([a-z]|_)*$'
-PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+from audit import PROBLEMCHARS
 
 # Make sure the fields order in the csvs matches the column order in the sql table schema
 NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
@@ -178,21 +191,112 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
-CHANGES_FIELDS = ['original', 'new']
+CHANGES_FIELDS = ['key', 'original', 'new', 'count', 'first_id']
+
+# Output csvs and their fields, in the order they are opened by write_map
+OUTPUTS = [(NODES_PATH, NODE_FIELDS),
+           (NODE_TAGS_PATH, NODE_TAGS_FIELDS),
+           (WAYS_PATH, WAY_FIELDS),
+           (WAY_NODES_PATH, WAY_NODES_FIELDS),
+           (WAY_TAGS_PATH, WAY_TAGS_FIELDS),
+           (CHANGES_PATH, CHANGES_FIELDS)]
+
+# Parallel conversion: every worker gets this many byte ranges on average so
+# a slow range (e.g. one full of long ways) doesn't hold up the whole pool
+CHUNKS_PER_WORKER = 4
+# Top level elements can only start here; '<' is always escaped inside attribute values
+ELEMENT_START = re.compile(rb'<(?:node|way|relation)[\s/>]')
+SCAN_SIZE = 1 << 20
+# Distinct changes a ChangeLog counts before writing them out early
+CHANGES_MAX_ENTRIES = 1 << 20
+# Checkpointed conversion: input bytes between two checkpoints
+CHECKPOINT_BYTES = 64 << 20
 
 
 # ================================================== #
 #               Helper Functions (Provided)          #
 # ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+def get_element(osm_file, tags=('node', 'way', 'relation'), backend=DEFAULT_BACKEND):
+    """Yield element if it is the right type of tag (see parsers.py for the backends)"""
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    return parsers.get_element(osm_file, tags, backend)
+
+
+class ChunkReader(object):
+    """File-like view of the bytes [start, end) of an OSM file wrapped in a bare <osm> root,
+    so that iterparse (and therefore get_element) can parse one byte range on its own
+    """
+
+    def __init__(self, osm_file, start, end):
+        self._file = open(osm_file, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+        self._pending = [b'<osm>']
+
+    def read(self, size=-1):
+        if self._pending:
+            return self._pending.pop()
+        if self._remaining > 0:
+            data = self._file.read(self._remaining if size < 0 else min(size, self._remaining))
+            self._remaining = self._remaining - len(data) if data else 0
+            if data:
+                return data
+        if self._remaining == 0:
+            self._remaining = -1
+            return b'</osm>'
+        return b''
+
+    def close(self):
+        self._file.close()
+
+
+def next_element_start(osm_file, offset):
+    """Return the byte offset of the first top level element starting at or after offset, or None"""
+
+    osm_file.seek(offset)
+    carry = b''
+    while True:
+        block = osm_file.read(SCAN_SIZE)
+        if not block:
+            return None
+        data = carry + block
+        match = ELEMENT_START.search(data)
+        if match:
+            return offset - len(carry) + match.start()
+        # keep enough of the tail to match a tag split across two blocks
+        carry = data[-len(b'<relation '):]
+        offset += len(block)
+
+
+def elements_end(osm_file, size):
+    """Return the byte offset of the closing </osm> tag, or size if there is none"""
+
+    osm_file.seek(max(size - SCAN_SIZE, 0))
+    tail = osm_file.read()
+    end = tail.rfind(b'</osm>')
+    return size if end == -1 else max(size - SCAN_SIZE, 0) + end
+
+
+def find_chunks(file_in, count):
+    """Split file_in into at most count (start, end) byte ranges that each
+    begin on a top level element and together cover every node and way in order
+    """
+
+    size = os.path.getsize(file_in)
+    with open(file_in, 'rb') as osm_file:
+        first = next_element_start(osm_file, 0)
+        if first is None:
+            return []
+        end = elements_end(osm_file, size)
+
+        offsets = [first]
+        for i in range(1, count):
+            offset = next_element_start(osm_file, max(size * i // count, offsets[-1] + 1))
+            if offset is None or offset >= end:
+                break
+            offsets.append(offset)
+        offsets.append(end)
+    return list(zip(offsets[:-1], offsets[1:]))
 
 '''
 def validate_element(element, validator, schema=SCHEMA):
@@ -229,8 +333,88 @@ class UnicodeDictWriter(csv.DictWriter, object):
 #               data prep functions                  #
 # ================================================== #
 
-from audit import street_type, zip_type, nesw_mapping, street_mapping, viet_mapping, \
-                is_street_name, is_phone, is_zip, substitute, update_name, update_phone, update_zip
+CLEANER_CACHE_SIZE = 1 << 16
+
+# The cleaning rules (rules.json unless process_map is given another rule file) and
+# tag "k" value -> their cleaner for its values, each behind a bounded cache since the
+# same values repeat across thousands of elements
+RULES = rules.load_rules()
+CLEANERS = {k: RULES.cleaner(k, CLEANER_CACHE_SIZE) for k in RULES.chains}
+
+
+def use_rules(rules_path):
+    """ Clean with the rules of rules_path from now on """
+
+    global RULES
+    RULES = rules.load_rules(rules_path)
+    CLEANERS.clear()
+    CLEANERS.update((k, RULES.cleaner(k, CLEANER_CACHE_SIZE)) for k in RULES.chains)
+
+
+def cleaner_stats():
+    """ cache hits and misses of every cleaner in CLEANERS as {k: (hits, misses)} """
+
+    return {k: cleaner.cache_info()[:2] for k, cleaner in CLEANERS.items()}
+
+
+def stats_since(before):
+    """ cleaner_stats() accumulated since the snapshot before """
+
+    return {k: (hits - before[k][0], misses - before[k][1])
+            for k, (hits, misses) in cleaner_stats().items()}
+
+
+# Compact rows: tuples in the csv column order instead of one dict per row, so
+# they can go straight to csv.writer/executemany without a lookup per field
+NodeRow = namedtuple('NodeRow', NODE_FIELDS)
+WayRow = namedtuple('WayRow', WAY_FIELDS)
+TagRow = namedtuple('TagRow', NODE_TAGS_FIELDS)  # same columns as WAY_TAGS_FIELDS
+ShapedNode = namedtuple('ShapedNode', ['node', 'node_tags'])
+ShapedWay = namedtuple('ShapedWay', ['way', 'way_nodes', 'way_tags'])
+
+
+class WayNodes(object):
+    """ way_nodes rows of one way: the node ids in an array('q'), position being the index
+        (so ways_nodes.csv has every ref in canonical integer form, e.g. ref="0012" as 12)
+    """
+
+    __slots__ = ('id', 'node_ids')
+
+    def __init__(self, way_id):
+        self.id = way_id
+        self.node_ids = array('q')
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def rows(self):
+        """ (id, node_id, position) tuples in WAY_NODES_FIELDS order """
+        return zip(repeat(self.id), self.node_ids, range(len(self.node_ids)))
+
+
+def tag_row(element_id, secondary, default_type, logger):
+    """ load sub-element of ways_tags and nodes_tags elements as a TagRow, see load_tag """
+
+    k = secondary.attrib['k']
+    v = secondary.attrib['v']
+    tag_type, colon, key = k.partition(':')
+    if not colon:
+        key, tag_type = k, default_type
+
+    # cleans values for certain keys
+    cleaner = CLEANERS.get(k)
+    if cleaner:
+        value, fired = cleaner(v)
+        if fired:
+            RULES.hits.update(fired)
+    else:
+        value = v
+
+    # testing
+    if value != v:
+        logger.add(k, v, value, element_id)
+    return TagRow(element_id, key, value, tag_type)
+
 
 def load_tag(element, secondary, default_type, logger):
     """ load sub-element of ways_tags and nodes_tags elements
@@ -238,136 +422,484 @@ def load_tag(element, secondary, default_type, logger):
             element -- node or way element containing sub-element with "tag"
             secondary -- element nested under above element
             default_type -- default type if secondary does not specify one
-            logger -- DictWriter object to log any data cleaning performed
+            logger -- ChangeLog object to log any data cleaning performed
         returns:
             dictionary containing keys 'key,' 'type' and 'value' and corresponding values
     """
 
-    newtag = {}
-    newtag['id'] = element.attrib['id']
-    if ":" not in secondary.attrib['k']:
-        newtag['key'] = secondary.attrib['k']
-        newtag['type'] = default_type
-    else:
-        newtag['key'] = secondary.attrib['k'][(secondary.attrib['k'].index(':') + 1):]
-        newtag['type'] = secondary.attrib['k'][:(secondary.attrib['k']).index(':')]
-
-    # cleans values for certain keys
-    if is_street_name(secondary):
-        street_name = update_name(secondary.attrib['v'])
-        newtag['value'] = street_name
-    elif is_phone(secondary):
-        phone = update_phone(secondary.attrib['v'])
-        newtag['value'] = phone
-    elif is_zip(secondary):
-        zipcode = update_zip(secondary.attrib['v'])
-        newtag['value'] = zipcode
-    else:
-        newtag['value'] = secondary.attrib['v']
-
-    # testing
-    if newtag['value'] != secondary.attrib['v']:
-        changes = {'original': secondary.attrib['v'], 'new': newtag['value']}
-        logger.writerow(changes)
-    return newtag
-
+    return tag_row(element.attrib['id'], secondary, default_type, logger)._asdict()
 
 
-def shape_element(element, logger, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """ Clean and shape node or way XML element to Python dict..
-        logger argument accepts DictWriter object in order to track any changes made
+def shape_rows(element, logger, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
+               problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """ Clean and shape node or way XML element to a ShapedNode or ShapedWay of compact rows
+        (element attributes missing from the XML are None)
     """
 
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
+    attrib = element.attrib
+    element_id = attrib['id']
     tags = []
 
     # for top element node
     if element.tag == 'node':
-        for attrib, value in iter(element.attrib.items()):
-            if attrib in node_attr_fields:
-                node_attribs[attrib] = value
+        row = tuple(attrib.get(f) for f in node_attr_fields)
+        if node_attr_fields is NODE_FIELDS:
+            row = NodeRow._make(row)
 
         # for elements within the top element
-        for secondary in element.iter():
-            if secondary.tag == 'tag':
-                if problem_chars.match(secondary.attrib['k']) is not None:
-                    continue
-                else:
-                    newtag = load_tag(element, secondary, default_tag_type, logger)
-                    tags.append(newtag)
-        return {'node': node_attribs, 'node_tags': tags}
+        for secondary in element.iter('tag'):
+            if problem_chars.match(secondary.attrib['k']) is None:
+                tags.append(tag_row(element_id, secondary, default_tag_type, logger))
+        return ShapedNode(row, tags)
 
     # for top element way
     elif element.tag == 'way':
-        for attrib, value in iter(element.attrib.items()):
-            if attrib in way_attr_fields:
-                way_attribs[attrib] = value
+        row = tuple(attrib.get(f) for f in way_attr_fields)
+        if way_attr_fields is WAY_FIELDS:
+            row = WayRow._make(row)
 
-        counter = 0
+        way_nodes = WayNodes(element_id)
+        node_ids = way_nodes.node_ids
         for secondary in element.iter():
             if secondary.tag == 'tag':
-                if problem_chars.match(secondary.attrib['k']) is not None:
-                    continue
-                else:
-                    newtag = load_tag(element, secondary, default_tag_type, logger)
-                    tags.append(newtag)
-            if secondary.tag == 'nd':
-                newnd = {}
-                newnd['id'] = element.attrib['id']
-                newnd['node_id'] = secondary.attrib['ref']
-                newnd['position'] = counter
-                counter += 1
-                way_nodes.append(newnd)
+                if problem_chars.match(secondary.attrib['k']) is None:
+                    tags.append(tag_row(element_id, secondary, default_tag_type, logger))
+            elif secondary.tag == 'nd':
+                node_ids.append(int(secondary.attrib['ref']))
+        return ShapedWay(row, way_nodes, tags)
+
+
+def shape_element(element, logger, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """ Clean and shape node or way XML element to Python dict..
+        logger argument accepts ChangeLog object in order to track any changes made
+        (a dict view of shape_rows, kept for compatibility: values are strings as
+        in the XML, way node refs aside, which come back in canonical integer form)
+    """
+
+    el = shape_rows(element, logger, node_attr_fields, way_attr_fields, problem_chars,
+                    default_tag_type)
+    if isinstance(el, ShapedNode):
+        return {'node': {f: v for f, v in zip(node_attr_fields, el.node) if v is not None},
+                'node_tags': [tag._asdict() for tag in el.node_tags]}
+    elif isinstance(el, ShapedWay):
+        return {'way': {f: v for f, v in zip(way_attr_fields, el.way) if v is not None},
+                'way_nodes': [{'id': way_id, 'node_id': str(node_id), 'position': position}
+                              for way_id, node_id, position in el.way_nodes.rows()],
+                'way_tags': [tag._asdict() for tag in el.way_tags]}
 
-        return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+
+def shape_map(file_in, logger, backend=DEFAULT_BACKEND):
+    """ Yield the shape_rows result of every node and way in file_in """
+
+    for element in get_element(file_in, tags=('node', 'way'), backend=backend):
+        el = shape_rows(element, logger)
+        if el:
+            yield el
 
 
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in):
-    """ Iteratively process each XML element and write to csv(s) """
+class ChangeLog(object):
+    """ Change log of the tag cleaning: one CHANGES_FIELDS row per distinct (key, original, new)
+        change with how often it was made and the id of the first element it was made to
+        Changes are counted in memory and only written out, by a background thread, on
+        flush() and close(); max_entries distinct changes are written out early, in which
+        case a change gets a row (and count) in each batch it was made in
+    """
+
+    def __init__(self, out_file, header=True, max_entries=CHANGES_MAX_ENTRIES):
+        self.writer = csv.writer(out_file)
+        if header:
+            self.writer.writerow(CHANGES_FIELDS)
+        self.max_entries = max_entries
+        self.counts = {}
+        self.error = None
+        self.batches = queue.Queue()
+        self.thread = threading.Thread(target=self.write_batches)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, k, original, new, element_id, count=1):
+        entry = self.counts.get((k, original, new))
+        if entry is None:
+            self.counts[(k, original, new)] = [count, element_id]
+            if len(self.counts) >= self.max_entries:
+                self.spill()
+        else:
+            entry[0] += count
+
+    def spill(self):
+        if self.counts:
+            self.batches.put(self.counts)
+            self.counts = {}
+
+    def write_batches(self):
+        while True:
+            counts = self.batches.get()
+            try:
+                if counts is None:
+                    return
+                self.writer.writerows(change + (count, first_id)
+                                      for change, (count, first_id) in counts.items())
+            except Exception as e:
+                # raised again by flush() in the thread using the log
+                self.error = e
+            finally:
+                self.batches.task_done()
+
+    def flush(self):
+        """ Write out every change counted so far """
+        self.spill()
+        self.batches.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.flush()
+        self.batches.put(None)
+        self.thread.join()
+
+
+def read_changes(path, header=True):
+    """ Yield the (key, original, new, count, first_id) rows of a (maybe compressed) change log """
+
+    with compressed.open_text(path) as changes_file:
+        reader = csv.reader(changes_file)
+        if header:
+            next(reader, None)
+        for k, original, new, count, first_id in reader:
+            yield k, original, new, int(count), first_id
+
+
+def merge_changes(paths, out_path=CHANGES_PATH, compression=None, header=True):
+    """ Sum up the change logs at paths, in order, into one row per distinct change at out_path
+        (which may be one of paths); header says whether the logs at paths have one
+    """
+
+    with compressed.open_output(out_path + '.tmp', 'w', compression) as out_file:
+        log = ChangeLog(out_file)
+        for path in paths:
+            for k, original, new, count, first_id in read_changes(path, header):
+                log.add(k, original, new, first_id, count)
+        log.close()
+    os.replace(out_path + '.tmp', out_path)
 
-    with codecs.open(NODES_PATH, 'w', encoding='utf-8') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w', encoding='utf-8') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w', encoding='utf-8') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w', encoding='utf-8') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w', encoding='utf-8') as way_tags_file, \
-         codecs.open(CHANGES_PATH, 'w', encoding='utf-8') as changes_file:
 
+def output_path(path, compression=None):
+    """ path of an output csv when written compressed with compression """
 
-        nodes_writer = csv.DictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = csv.DictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = csv.DictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = csv.DictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = csv.DictWriter(way_tags_file, WAY_TAGS_FIELDS)
-        changes_writer = csv.DictWriter(changes_file, CHANGES_FIELDS)
+    return path + compressed.EXTENSIONS[compression] if compression else path
+
+
+class CsvSink(object):
+    """ Writers for the OUTPUTS csv(s), at their paths + suffix
+        mode 'a' appends to csv(s) that already have their header
+        compression 'gz', 'bz2', 'xz' or 'zst' writes them compressed (see compressed.py)
+    """
+
+    def __init__(self, suffix='', mode='w', header=True, compression=None):
+        self.paths = [output_path(path, compression) + suffix for path, _ in OUTPUTS]
+        self.files = [compressed.open_output(path, mode, compression) for path in self.paths]
+        (self.nodes_writer, self.node_tags_writer, self.ways_writer, self.way_nodes_writer,
+         self.way_tags_writer) = [csv.writer(f) for f in self.files[:-1]]
+
+        if header:
+            self.nodes_writer.writerow(NODE_FIELDS)
+            self.node_tags_writer.writerow(NODE_TAGS_FIELDS)
+            self.ways_writer.writerow(WAY_FIELDS)
+            self.way_nodes_writer.writerow(WAY_NODES_FIELDS)
+            self.way_tags_writer.writerow(WAY_TAGS_FIELDS)
+        self.changes = ChangeLog(self.files[-1], header)
+
+    def write(self, el):
+        """Write every row of one shape_rows result"""
+        if isinstance(el, ShapedNode):
+            self.nodes_writer.writerow(el.node)
+            self.node_tags_writer.writerows(el.node_tags)
+        else:
+            self.ways_writer.writerow(el.way)
+            self.way_nodes_writer.writerows(el.way_nodes.rows())
+            self.way_tags_writer.writerows(el.way_tags)
+
+    def sync(self):
+        """Get everything written so far onto the disk; returns {path: size in bytes}"""
+        self.changes.flush()
+        sizes = {}
+        for path, out_file in zip(self.paths, self.files):
+            out_file.flush()
+            os.fsync(out_file.fileno())
+            sizes[path] = out_file.tell()
+        return sizes
+
+    def close(self):
+        try:
+            self.changes.close()
+        finally:
+            for out_file in self.files:
+                out_file.close()
+
+
+def write_map(file_in, suffix='', header=True, backend=DEFAULT_BACKEND, geometry_mode=None,
+              compression=None):
+    """ Iteratively process each XML element in file_in (a path or file object) and
+        write to csv(s), appending suffix to every output path
+        geometry_mode 'bbox' or 'line' also builds the node index, way geometries and
+        dangling references in the same pass (see geometry.py)
+        compression writes the csv(s) compressed (see CsvSink)
+    """
+
+    builder = geometry.GeometryBuilder(geometry_mode) if geometry_mode else None
+
+    sink = CsvSink(suffix, header=header, compression=compression)
+    try:
+        for el in shape_map(file_in, sink.changes, backend):
+            sink.write(el)
+            if builder:
+                if isinstance(el, ShapedNode):
+                    builder.add_node(el.node[0], el.node[1], el.node[2])
+                else:
+                    builder.add_way(el.way_nodes.id, el.way_nodes.node_ids)
+    finally:
+        sink.close()
 
+    if builder:
+        return builder.close()
 
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-        changes_writer.writeheader()
 
+def input_stamp(file_in):
+    """ what a checkpoint remembers of its input, to tell if it is still the same file """
+
+    stat = os.stat(file_in)
+    return {'path': os.path.abspath(file_in), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def read_checkpoint(checkpoint_path=CHECKPOINT_PATH):
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def write_checkpoint(checkpoint, checkpoint_path=CHECKPOINT_PATH):
+    """ Replace the checkpoint file in one step, so a crash leaves either the old or the new one """
+
+    with open(checkpoint_path + '.tmp', 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+
+def checkpointed_map(file_in, backend=DEFAULT_BACKEND, checkpoint_bytes=CHECKPOINT_BYTES,
+                     checkpoint_path=CHECKPOINT_PATH, resume=False):
+    """ write_map for file_in, a step of about checkpoint_bytes of input at a time
+        After each step the csv(s) are synced and a checkpoint records the input offset
+        of the next element, the last element written and the size of every csv.
+        resume continues an interrupted run from its last checkpoint: the csv(s) are cut
+        back to the recorded sizes, so rows written after it are neither lost nor doubled.
+        Once the input is done the checkpoint is marked finished before the change log is
+        summed up, and resuming a finished run only sums it up again.
+    """
+
+    stamp = input_stamp(file_in)
+    checkpoint = read_checkpoint(checkpoint_path) if resume else None
+    if checkpoint is not None and checkpoint['input'] != stamp:
+        raise ValueError('{0} was written for another input than {1}'.format(
+            checkpoint_path, file_in))
+    if checkpoint is not None and checkpoint.get('finished'):
+        finish_checkpointed(checkpoint_path)
+        return
+    if checkpoint is not None:
+        for path, size in checkpoint['outputs'].items():
+            os.truncate(path, size)
+        sink = CsvSink(mode='a', header=False)
+    else:
+        sink = CsvSink()
+
+    last = checkpoint['last'] if checkpoint else None
+    try:
+        with open(file_in, 'rb') as osm_file:
+            offset = checkpoint['offset'] if checkpoint else next_element_start(osm_file, 0)
+            end = elements_end(osm_file, stamp['size'])
+            while offset is not None and offset < end:
+                stop = next_element_start(osm_file, offset + checkpoint_bytes)
+                stop = end if stop is None else min(stop, end)
+                reader = ChunkReader(file_in, offset, stop)
+                try:
+                    for el in shape_map(reader, sink.changes, backend):
+                        sink.write(el)
+                        last = ['node', el.node[0]] if isinstance(el, ShapedNode) else ['way', el.way[0]]
+                finally:
+                    reader.close()
+                offset = stop
+                write_checkpoint({'input': stamp, 'offset': offset, 'last': last,
+                                  'outputs': sink.sync()}, checkpoint_path)
+    finally:
+        sink.close()
+
+    # from here on the csv(s) no longer match the recorded sizes, so a resume
+    # mustn't truncate them
+    write_checkpoint({'input': stamp, 'finished': True}, checkpoint_path)
+    finish_checkpointed(checkpoint_path)
+
+
+def finish_checkpointed(checkpoint_path=CHECKPOINT_PATH):
+    """ Sum up the counts every checkpointed step wrote to the change log and drop the
+        checkpoint; summing up an already summed up log leaves it as it is
+    """
+
+    merge_changes([CHANGES_PATH])
+    # finished, nothing left to resume
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+def part_suffix(part):
+    return '.part%04d' % part
+
+
+def process_chunk(file_in, start, end, part, backend=DEFAULT_BACKEND, compression=None,
+                  rules_path=rules.RULES_PATH):
+    """ Shape the elements in byte range [start, end) of file_in into headerless part csv(s)
+        returns this chunk's cleaner stats and rule hits
+    """
+
+    if rules_path != RULES.path:
+        use_rules(rules_path)
+    before = cleaner_stats()
+    hits_before = RULES.hits.copy()
+    reader = ChunkReader(file_in, start, end)
+    try:
+        write_map(reader, part_suffix(part), header=False, backend=backend, compression=compression)
+    finally:
+        reader.close()
+    # the caches live on between the chunks a worker gets, so report this chunk's share
+    return stats_since(before), RULES.hits - hits_before
+
+
+def merge_parts(parts, compression=None):
+    """ Concatenate part csv(s) 0..parts-1 in order under a single header, removing the parts
+        (gzip, bzip2, xz and zstd streams can be concatenated just the same)
+    """
+
+    for path, fields in OUTPUTS:
+        path = output_path(path, compression)
+        part_paths = [path + part_suffix(part) for part in range(parts)]
+        if fields is CHANGES_FIELDS:
+            # the same change is usually made in many parts, so sum them up instead
+            merge_changes(part_paths, path, compression, header=False)
+            for part_path in part_paths:
+                os.remove(part_path)
+            continue
+        with compressed.open_output(path, 'w', compression) as out_file:
+            csv.DictWriter(out_file, fields).writeheader()
+        with open(path, 'ab') as out_file:
+            for part in range(parts):
+                with open(path + part_suffix(part), 'rb') as part_file:
+                    shutil.copyfileobj(part_file, out_file, SCAN_SIZE)
+                os.remove(path + part_suffix(part))
+
+
+def process_map(file_in, workers=1, backend=DEFAULT_BACKEND, geometry_mode=None,
+                checkpoint_bytes=None, resume=False, compression=None, rules_path=None):
+    """ Iteratively process each XML element and write to csv(s)
+        workers > 1 shapes byte ranges of file_in in a process pool; the output is
+        identical to the single process run
+        geometry_mode 'bbox' or 'line' also writes the node index and way geometries
+        checkpoint_bytes checkpoints the run every that many input bytes and resume
+        continues an interrupted checkpointed run (see checkpointed_map)
+        compression writes the csv(s) compressed, e.g. nodes.csv.gz for 'gz'; file_in
+        itself may be compressed too, except for the parallel and checkpointed runs,
+        which need to seek in it
+        rules_path cleans with the rules of another rule file (see rules.py); RULES.hits
+        counts how often each rule changed a value
+        returns (the cleaner cache hits and misses for this run (see cleaner_stats),
+        (nodes indexed, ways, dangling references) with geometry_mode, else None)
+    """
 
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element, changes_writer)
-            if el:
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+    if rules_path and rules_path != RULES.path:
+        use_rules(rules_path)
+
+    compressed_input = compressed.compression_of(file_in) is not None
+    if checkpoint_bytes or resume:
+        if workers > 1 or geometry_mode or compression or compressed_input:
+            raise ValueError('checkpointed runs use a single process, no geometry and '
+                             'uncompressed input and output')
+        before = cleaner_stats()
+        checkpointed_map(file_in, backend, checkpoint_bytes or CHECKPOINT_BYTES, resume=resume)
+        return stats_since(before), None
+
+    if workers <= 1:
+        before = cleaner_stats()
+        counts = write_map(file_in, backend=backend, geometry_mode=geometry_mode, compression=compression)
+        return stats_since(before), counts
+    if compressed_input:
+        raise ValueError('{0} is compressed, convert it with a single worker'.format(file_in))
+
+    chunks = find_chunks(file_in, workers * CHUNKS_PER_WORKER)
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.starmap(process_chunk, [(file_in, start, end, part, backend, compression,
+                                                RULES.path)
+                                               for part, (start, end) in enumerate(chunks)])
+    finally:
+        pool.close()
+        pool.join()
+    merge_parts(len(chunks), compression)
+    counts = None
+    if geometry_mode:
+        # workers only see their own nodes, so index the merged csv(s) instead
+        counts = geometry.build_from_csv(geometry_mode, output_path(NODES_PATH, compression),
+                                         output_path(WAY_NODES_PATH, compression))
+
+    stats = {k: (0, 0) for k in CLEANERS}
+    for chunk, rule_hits in results:
+        for k, (hits, misses) in chunk.items():
+            stats[k] = (stats[k][0] + hits, stats[k][1] + misses)
+        RULES.hits.update(rule_hits)
+    return stats, counts
+
+
+def print_cleaner_stats(stats):
+    for k, (hits, misses) in sorted(stats.items()):
+        calls = hits + misses
+        print('{0:14} {1:9d} calls {2:9d} hits {3:9d} misses {4:6.1%} hit rate'.format(
+            k, calls, hits, misses, hits / calls if calls else 0))
 
 
 if __name__ == '__main__':
     # Note: Validation is ~ 10X slower. For the project consider using a small
     # sample of the map when validating.
-    process_map(OSM_PATH)
+    parser = argparse.ArgumentParser(description='Convert an OSM XML file to csv(s)')
+    parser.add_argument('osm_file', nargs='?', default=OSM_PATH)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes (default: 1)')
+    parser.add_argument('--parser', default=DEFAULT_BACKEND, choices=sorted(BACKENDS),
+                        help='XML parser backend (default: %(default)s)')
+    parser.add_argument('--stats', action='store_true',
+                        help='print cache hit rates of the tag cleaners and hits of every rule')
+    parser.add_argument('--rules', default=rules.RULES_PATH,
+                        help='cleaning rule file (default: %(default)s)')
+    parser.add_argument('--geometry', choices=sorted(geometry.GEOMETRY_FIELDS),
+                        help='also index node locations and write way geometries of this kind')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='sync the csv(s) and record a checkpoint every --checkpoint-bytes '
+                             'of input, in ' + CHECKPOINT_PATH)
+    parser.add_argument('--checkpoint-bytes', type=int, default=CHECKPOINT_BYTES,
+                        help='input bytes between checkpoints (default: %(default)s)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted --checkpoint run from its last checkpoint')
+    parser.add_argument('--compress', choices=compressed.COMPRESSIONS,
+                        help='write the csv(s) compressed with this (input compression is detected)')
+    args = parser.parse_args()
+    stats, geometry_counts = process_map(args.osm_file, workers=args.workers, backend=args.parser,
+                                         geometry_mode=args.geometry,
+                                         checkpoint_bytes=args.checkpoint_bytes if args.checkpoint or args.resume else None,
+                                         resume=args.resume, compression=args.compress, rules_path=args.rules)
+    if geometry_counts:
+        print('{0} nodes indexed, {1} ways, {2} dangling references'.format(*geometry_counts))
+    if args.stats:
+        print_cleaner_stats(stats)
+        rules.print_hit_counts(RULES)
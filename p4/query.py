@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Spatial queries over the nodes of a database built by database.py, backed by
+a SQLite R*Tree index on their lat/lon (nodes_rtree, built on first use).
+
+- bbox: nodes inside a lat/lon box
+- radius: nodes within km of a point, nearest first
+- nearest: the k nodes nearest to a point
+
+Every query can be narrowed to nodes with a tag of the given key, value and/or
+type (as in nodes_tags), e.g. the restaurants within 2 km of Disneyland:
+
+    conn = sqlite3.connect('oc.db')
+    radius(conn, 33.8121, -117.9190, 2, key='amenity', value='restaurant')
+
+Boxes may run past longitude ±180 and are wrapped around the antimeridian.
+osc.apply_changes keeps the index up to date (update_rtree).
+
+Each query has a full scan counterpart (no spatial index) that benchmark()
+times it against; 'python query.py oc.db' runs that benchmark.
+"""
+
+import argparse
+import math
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from database import DB_PATH
+
+EARTH_RADIUS_KM = 6371.0088
+# widens query boxes a little, so a node on the radius isn't lost to rounding
+BOX_MARGIN_DEGREES = 1e-9
+# node ids per statement in update_rtree, under SQLite's limit on bound parameters
+RTREE_BATCH = 500
+
+RTREE_SCHEMA = """
+CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes WHERE lat IS NOT NULL AND lon IS NOT NULL;
+"""
+
+
+def rtree_exists(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'nodes_rtree'").fetchone() is not None
+
+
+def ensure_rtree(conn):
+    """build the nodes_rtree index the first time it's needed"""
+    if not rtree_exists(conn):
+        conn.executescript(RTREE_SCHEMA)
+        conn.commit()
+
+
+def update_rtree(conn, node_ids):
+    """bring the nodes_rtree rows of node_ids in line with nodes after they were created,
+    moved or deleted there (as osc.apply_changes does), if the index has been built
+    """
+    if not rtree_exists(conn):
+        return
+    node_ids = [int(node_id) for node_id in node_ids]
+    for start in range(0, len(node_ids), RTREE_BATCH):
+        batch = node_ids[start:start + RTREE_BATCH]
+        marks = ', '.join('?' * len(batch))
+        conn.execute('DELETE FROM nodes_rtree WHERE id IN ({0})'.format(marks), batch)
+        conn.execute('INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes '
+                     'WHERE id IN ({0}) AND lat IS NOT NULL AND lon IS NOT NULL'.format(marks), batch)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """great circle distance in km"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def around(lat, lon, km):
+    """(min_lat, min_lon, max_lat, max_lon) of a box holding every point within km of (lat, lon)
+
+    On the haversine sphere the circle reaches km / EARTH_RADIUS_KM radians north
+    and south, and asin(sin(r) / cos(lat)) east and west. The longitudes may run
+    past ±180 (see lon_ranges); a circle reaching a pole or going all the way
+    around gets every longitude.
+    """
+    r = km / EARTH_RADIUS_KM
+    dlat = math.degrees(r) + BOX_MARGIN_DEGREES
+    min_lat, max_lat = max(-90.0, lat - dlat), min(90.0, lat + dlat)
+    sin_r, cos_lat = math.sin(r), math.cos(math.radians(lat))
+    if min_lat <= -90.0 or max_lat >= 90.0 or r >= math.pi / 2 or sin_r >= cos_lat:
+        return min_lat, -180.0, max_lat, 180.0
+    dlon = math.degrees(math.asin(sin_r / cos_lat)) + BOX_MARGIN_DEGREES
+    if dlon >= 180.0:
+        return min_lat, -180.0, max_lat, 180.0
+    return min_lat, lon - dlon, max_lat, lon + dlon
+
+
+def lon_ranges(min_lon, max_lon):
+    """[(west, east)] ranges within -180..180 covering min_lon..max_lon, which may run
+    past one of ±180 and wrap around the antimeridian
+    """
+    if max_lon - min_lon >= 360.0:
+        return [(-180.0, 180.0)]
+    if min_lon < -180.0:
+        return [(min_lon + 360.0, 180.0), (-180.0, max_lon)]
+    if max_lon > 180.0:
+        return [(min_lon, 180.0), (-180.0, max_lon - 360.0)]
+    return [(min_lon, max_lon)]
+
+
+def tag_filter(key=None, value=None, tag_type=None):
+    """SQL condition on n.id and its parameters for nodes having a matching tag"""
+    conditions, params = [], []
+    for column, wanted in (('key', key), ('value', value), ('type', tag_type)):
+        if wanted is not None:
+            conditions.append('t.{0} = ?'.format(column))
+            params.append(wanted)
+    if not conditions:
+        return '', []
+    return (' AND EXISTS (SELECT 1 FROM nodes_tags t WHERE t.id = n.id AND {0})'.format(
+        ' AND '.join(conditions)), params)
+
+
+def bbox(conn, min_lat, min_lon, max_lat, max_lon, key=None, value=None, tag_type=None):
+    """(id, lat, lon) of the nodes inside the box, by id; a box running past ±180
+    is one R*Tree query per side of the antimeridian
+    """
+    ensure_rtree(conn)
+    condition, params = tag_filter(key, value, tag_type)
+    rows = []
+    for west, east in lon_ranges(min_lon, max_lon):
+        # the R*Tree keeps float32 boxes rounded outwards, so it only narrows the
+        # candidates down and the exact lat/lon test is done on nodes
+        rows.extend(conn.execute(
+            'SELECT n.id, n.lat, n.lon FROM nodes_rtree r JOIN nodes n ON n.id = r.id '
+            'WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ? '
+            'AND n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?' + condition,
+            [min_lat, max_lat, west, east] * 2 + params))
+    return sorted(rows)
+
+
+def scan_bbox(conn, min_lat, min_lon, max_lat, max_lon, key=None, value=None, tag_type=None):
+    """bbox without the spatial index"""
+    condition, params = tag_filter(key, value, tag_type)
+    rows = []
+    for west, east in lon_ranges(min_lon, max_lon):
+        rows.extend(conn.execute(
+            'SELECT n.id, n.lat, n.lon FROM nodes n '
+            'WHERE n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?' + condition,
+            [min_lat, max_lat, west, east] + params))
+    return sorted(rows)
+
+
+def by_distance(rows, lat, lon, km=None):
+    """(distance km, id, lat, lon) of rows, nearest first, optionally only those within km"""
+    found = [(haversine(lat, lon, node_lat, node_lon), node_id, node_lat, node_lon)
+             for node_id, node_lat, node_lon in rows]
+    if km is not None:
+        found = [row for row in found if row[0] <= km]
+    found.sort()
+    return found
+
+
+def radius(conn, lat, lon, km, key=None, value=None, tag_type=None):
+    """(distance km, id, lat, lon) of the nodes within km of (lat, lon), nearest first"""
+    return by_distance(bbox(conn, *around(lat, lon, km), key=key, value=value, tag_type=tag_type),
+                       lat, lon, km)
+
+
+def scan_radius(conn, lat, lon, km, key=None, value=None, tag_type=None):
+    """radius without the spatial index"""
+    condition, params = tag_filter(key, value, tag_type)
+    rows = conn.execute('SELECT n.id, n.lat, n.lon FROM nodes n WHERE n.lat IS NOT NULL' + condition,
+                        params).fetchall()
+    return by_distance(rows, lat, lon, km)
+
+
+def nearest(conn, lat, lon, k=10, key=None, value=None, tag_type=None, start_km=0.5):
+    """(distance km, id, lat, lon) of the k nodes nearest to (lat, lon)
+
+    Searches ever larger boxes around the point; once k nodes lie within the
+    search radius no node outside the box can be nearer.
+    """
+    km = start_km
+    while True:
+        found = radius(conn, lat, lon, km, key, value, tag_type)
+        if len(found) >= k or km >= math.pi * EARTH_RADIUS_KM:
+            return found[:k]
+        km *= 2
+
+
+def scan_nearest(conn, lat, lon, k=10, key=None, value=None, tag_type=None):
+    """nearest without the spatial index"""
+    return scan_radius(conn, lat, lon, None, key, value, tag_type)[:k]
+
+
+def destination(lat, lon, km, bearing):
+    """(lat, lon) km from (lat, lon) along bearing (degrees clockwise from north)"""
+    lat, lon, bearing = map(math.radians, (lat, lon, bearing))
+    r = km / EARTH_RADIUS_KM
+    # step from the point's unit vector along the great circle heading north/east
+    # by bearing; atan2 keeps it accurate next to the poles, where asin isn't
+    sin_lat, cos_lat, sin_lon, cos_lon = math.sin(lat), math.cos(lat), math.sin(lon), math.cos(lon)
+    north, east = math.cos(bearing) * math.sin(r), math.sin(bearing) * math.sin(r)
+    x = cos_lat * cos_lon * math.cos(r) - sin_lat * cos_lon * north - sin_lon * east
+    y = cos_lat * sin_lon * math.cos(r) - sin_lat * sin_lon * north + cos_lon * east
+    z = sin_lat * math.cos(r) + cos_lat * north
+    return math.degrees(math.atan2(z, math.hypot(x, y))), math.degrees(math.atan2(y, x))
+
+
+EDGE_CENTERS = [(0.0, -117.8), (33.7, -117.8), (60.0, -117.8), (80.0, -117.8),
+                (10.0, -179.999), (10.0, 179.999), (89.9999, 0.0), (-89.9999, 90.0)]
+
+
+def circle_edge(lat, lon, km):
+    """points just inside km of (lat, lon) all around it, and at its widest longitudes"""
+    inside = km * (1 - 1e-6)
+    points = [destination(lat, lon, inside, bearing) for bearing in range(0, 360, 15)]
+    r = inside / EARTH_RADIUS_KM
+    sin_r, cos_lat = math.sin(r), math.cos(math.radians(lat))
+    if sin_r < cos_lat:
+        widest_lat = math.degrees(math.asin(math.sin(math.radians(lat)) / math.cos(r)))
+        widest_dlon = math.degrees(math.asin(sin_r / cos_lat))
+        for widest_lon in (lon + widest_dlon, lon - widest_dlon):
+            points.append((widest_lat, (widest_lon + 180.0) % 360.0 - 180.0))
+    return points
+
+
+def check_queries(conn, lat, lon, km, points):
+    """assert that radius and nearest around (lat, lon) match their full scans"""
+    assert len(radius(conn, lat, lon, km)) == len(points), ('radius', lat, lon)
+    assert radius(conn, lat, lon, km) == scan_radius(conn, lat, lon, km), ('radius', lat, lon)
+    for k in (1, len(points)):
+        assert nearest(conn, lat, lon, k, start_km=km) == scan_nearest(conn, lat, lon, k), \
+            ('nearest', lat, lon)
+        assert nearest(conn, lat, lon, k) == scan_nearest(conn, lat, lon, k), ('nearest', lat, lon)
+
+
+def check_edges(km=1.0, centers=EDGE_CENTERS):
+    """check radius and nearest against their full scans where a wrong search box or
+    a stale index would show: nodes just inside km of each center (including across
+    the antimeridian and around the poles), nodes all over the globe, and nodes
+    created, moved and deleted by an .osc after the index was built
+    """
+    # imported here, osc imports this module
+    import database
+    import osc
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(work_dir, 'edges.db')
+        for lat, lon in centers:
+            conn = database.create_database(db_path)
+            points = circle_edge(lat, lon, km)
+            conn.executemany('INSERT INTO nodes (id, lat, lon) VALUES (?, ?, ?)',
+                             [(i, node_lat, node_lon) for i, (node_lat, node_lon) in enumerate(points)])
+            conn.commit()
+            check_queries(conn, lat, lon, km, points)
+            conn.close()
+
+        # nearest has to look around the whole globe to find them all
+        conn = database.create_database(db_path)
+        points = [(33.8, -117.9), (-33.8, 62.1), (0.0, 179.9), (-89.0, 10.0), (70.0, -170.0)]
+        conn.executemany('INSERT INTO nodes (id, lat, lon) VALUES (?, ?, ?)',
+                         [(i, node_lat, node_lon) for i, (node_lat, node_lon) in enumerate(points)])
+        conn.commit()
+        check_queries(conn, 33.8, -117.9, math.pi * EARTH_RADIUS_KM, points)
+        conn.close()
+
+        # the index is built before the diff is applied
+        conn = database.create_database(db_path)
+        conn.executemany('INSERT INTO nodes (id, lat, lon) VALUES (?, ?, ?)',
+                         [(1, 33.7, -117.8), (2, 33.7001, -117.8), (3, 33.7002, -117.8)])
+        conn.commit()
+        ensure_rtree(conn)
+        conn.close()
+        osc_path = os.path.join(work_dir, 'edges.osc')
+        with open(osc_path, 'w') as osc_file:
+            osc_file.write('<osmChange version="0.6">'
+                           '<create><node id="888888" lat="10.0" lon="10.0"/></create>'
+                           '<modify><node id="1" lat="10.001" lon="10.0"/></modify>'
+                           '<delete><node id="2"/></delete>'
+                           '</osmChange>')
+        osc.apply_changes(osc_path, db_path, os.path.join(work_dir, 'changes.csv'))
+        conn = sqlite3.connect(db_path)
+        check_queries(conn, 10.0, 10.0, 1.0, [(10.0, 10.0), (10.001, 10.0)])
+        check_queries(conn, 33.7, -117.8, 1.0, [(33.7002, -117.8)])
+        conn.close()
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def benchmark(db_path=DB_PATH, queries=100, km=1.0, k=10, seed=0):
+    """time random bbox/radius/nearest queries with and without the index,
+    checking that both give the same answers (and check_edges first)
+    """
+    check_edges(km)
+    conn = sqlite3.connect(db_path)
+    ensure_rtree(conn)
+    min_lat, max_lat, min_lon, max_lon = conn.execute(
+        'SELECT MIN(lat), MAX(lat), MIN(lon), MAX(lon) FROM nodes').fetchone()
+    rng = random.Random(seed)
+    points = [(rng.uniform(min_lat, max_lat), rng.uniform(min_lon, max_lon)) for _ in range(queries)]
+
+    cases = [('bbox', bbox, scan_bbox, lambda lat, lon: around(lat, lon, km)),
+             ('radius', radius, scan_radius, lambda lat, lon: (lat, lon, km)),
+             ('nearest', nearest, scan_nearest, lambda lat, lon: (lat, lon, k))]
+    for name, indexed, scan, args in cases:
+        timings = []
+        answers = []
+        for func in (indexed, scan):
+            start = time.perf_counter()
+            answers.append([func(conn, *args(lat, lon)) for lat, lon in points])
+            timings.append(time.perf_counter() - start)
+        assert answers[0] == answers[1], name
+        print('{0:8} {1:5d} queries  rtree {2:8.4f} s  full scan {3:8.4f} s  {4:8.1f}x'.format(
+            name, queries, timings[0], timings[1], timings[1] / timings[0]))
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark indexed spatial queries against full scans')
+    parser.add_argument('db', nargs='?', default=DB_PATH)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--km', type=float, default=1.0, help='bbox/radius query size')
+    parser.add_argument('-k', type=int, default=10, help='nodes per nearest query')
+    args = parser.parse_args()
+    benchmark(args.db, args.queries, args.km, args.k)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Declarative tag cleaning rules, so a region's fixes live in a rule file
+instead of code. A rule file (JSON, or YAML with PyYAML installed) maps a tag
+"k" value to the rules applied in turn to its values:
+
+{
+  "addr:postcode": [
+    {"name": "landmarks", "exact": {"disneyland": "92802"}, "ignore_case": true},
+    {"name": "zip", "function": "zip"}
+  ]
+}
+
+Every rule has a name and exactly one of these kinds, holding its mapping:
+- translate: character -> replacement, applied as one str.translate table
+- exact: whole value -> replacement, a dict lookup; a hit ends the chain
+- replace: token -> replacement, one alternation regex over every token,
+  matching a token at the "end" or "start" of the value or as a "word"
+  anywhere (at, default word)
+- directions: abbreviated direction -> direction, for runs of them at the
+  start or in the middle of a street name (N E Main St)
+- function: the name of a normaliser in FUNCTIONS
+
+ignore_case makes exact and replace case insensitive (directions always are).
+A value that a rule turns into None (e.g. an invalid phone number) is dropped
+and the rules after it are skipped.
+
+compile_rules builds a RuleSet once. RuleSet.cleaner(k) is the rule chain for
+one key; it returns the new value with the rules that changed it, and
+RuleSet.hits counts those per (k, rule name). rules.json holds the Orange
+County rules process.py uses by default (audit.py reports the postcodes and
+phones they change). To see how often every rule of a file fires on a map:
+
+    python rules.py oc.osm --rules rules.json
+"""
+
+import argparse
+import json
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules.json')
+
+zip_type = re.compile(r'^\d{5}(?:[-\s]?\d{4})?$')
+# one abbreviated direction of a run and the whitespace after it
+nesw_token = re.compile(r'(\S+)(\s)')
+
+
+def update_zip(zip):
+    """standardizes zip code to xxxxx or xxxxx-xxxx
+    (named places like Disneyland are exact rules of addr:postcode in rules.json)
+    """
+    
+    noletters = re.sub(r'^\D*|[a-zA-Z]|^D*$', '', zip)
+    if zip_type.match(noletters):
+        numbers = re.sub(r'\D', '', noletters)
+        if len(numbers) == 5:
+            return numbers
+        elif len(numbers) == 9:
+            numbers = numbers[:5] + '-' + numbers[5:]
+            return numbers
+    else:
+        return None
+
+
+def update_phone(number):
+    """standardize phone number to 10 consecutive digits"""
+    
+    digits = re.sub(r'[^0-9]', '', number)
+    if re.match(r'^1\d{10}$', digits):
+        digits = digits[1:]
+    if re.match(r'\d{10}$', digits):
+        return digits
+    else:
+        return None
+
+
+def alternation(mapping):
+    """regex alternation of the escaped mapping keys, longest first"""
+    return '|'.join(re.escape(key) for key in sorted(mapping, key=len, reverse=True))
+
+
+def directions_expander(lookup):
+    """replacement function spelling out a run of abbreviated directions matched by
+    a directions rule's regex (see compile_rule) with lookup, a casefolded mapping
+
+    Matches substituting r'\sKEY\s' and then r'^KEY\s' for each key in turn: every
+    replaced direction has its surrounding whitespace turned into single spaces, and a
+    direction is left alone when the same key was just replaced before it, since that
+    replacement already consumed the whitespace in between.
+    """
+    def expand_directions(match):
+        lead, run = match.groups()
+        parts = nesw_token.findall(run)
+        keys = [token.casefold() for token, _ in parts]
+
+        replaced = [True]
+        for i in range(1, len(keys)):
+            replaced.append(not (keys[i] == keys[i - 1] and replaced[i - 1] and (lead or i > 1)))
+
+        better_run = [' ' if lead else '']
+        for i, (token, space) in enumerate(parts):
+            better_run.append(lookup[keys[i]] if replaced[i] else token)
+            spaced = replaced[i] or (i + 1 < len(parts) and replaced[i + 1])
+            better_run.append(' ' if spaced else space)
+        return ''.join(better_run)
+    return expand_directions
+
+
+FUNCTIONS = {'phone': update_phone,
+             'zip': update_zip}
+
+KINDS = ('translate', 'exact', 'replace', 'directions', 'function')
+
+# where a replace token may be: (regex around the alternation, replacement around the new token)
+PLACES = {'end': (r'\s({0})$', ' {0}'),
+          'start': (r'^({0})\s', '{0} '),
+          'word': (r'(?<!\S)({0})(?!\S)', '{0}')}
+
+
+def load_rules(path=RULES_PATH):
+    """the rules of a JSON or YAML rule file, compiled into a RuleSet"""
+    with open(path, encoding='utf-8') as rules_file:
+        if os.path.splitext(path)[1] in ('.yaml', '.yml'):
+            import yaml
+            rules = yaml.safe_load(rules_file)
+        else:
+            rules = json.load(rules_file)
+    return compile_rules(rules, path)
+
+
+def rule_kind(k, rule):
+    kinds = [kind for kind in KINDS if kind in rule]
+    if len(kinds) != 1:
+        raise ValueError('rule {0!r} of {1!r} needs exactly one of {2}'.format(
+            rule.get('name'), k, ', '.join(KINDS)))
+    return kinds[0]
+
+
+def compile_rule(k, rule):
+    """(value -> new value function, whether a change ends the chain) for one rule"""
+    kind = rule_kind(k, rule)
+    mapping = rule[kind]
+    ignore_case = rule.get('ignore_case', False)
+
+    if kind == 'translate':
+        table = str.maketrans(mapping)
+        return (lambda value: value.translate(table)), False
+
+    if kind == 'exact':
+        if ignore_case:
+            lookup = {key.casefold(): new for key, new in mapping.items()}
+            return (lambda value: lookup.get(value.casefold(), value)), True
+        return (lambda value: mapping.get(value, value)), True
+
+    if kind == 'function':
+        if mapping not in FUNCTIONS:
+            raise ValueError('unknown function {0!r} in rule {1!r} of {2!r}'.format(
+                mapping, rule.get('name'), k))
+        return FUNCTIONS[mapping], False
+
+    if kind == 'directions':
+        lookup = {key.casefold(): new for key, new in mapping.items()}
+        run = re.compile(r'(^|\s)((?:(?:' + alternation(mapping) + r')\s)+)', re.I)
+        expand = directions_expander(lookup)
+        return (lambda value: run.sub(expand, value)), False
+
+    pattern, template = PLACES[rule.get('at', 'word')]
+    fold = str.casefold if ignore_case else (lambda token: token)
+    lookup = {fold(key): new for key, new in mapping.items()}
+    regex = re.compile(pattern.format(alternation(mapping)), re.I if ignore_case else 0)
+    replace = lambda match: template.format(lookup[fold(match.group(1))])
+    return (lambda value: regex.sub(replace, value)), False
+
+
+class RuleSet(object):
+    """Compiled rule chains per tag "k" value, and how often each rule changed a value"""
+
+    def __init__(self, chains, path=None):
+        self.chains = chains
+        self.path = path
+        self.hits = Counter()
+
+    def __contains__(self, k):
+        return k in self.chains
+
+    def clean(self, k, value):
+        """(cleaned value, ((k, rule name), ...) of the rules that changed it)"""
+        fired = []
+        for hit, func, final in self.chains[k]:
+            new = func(value)
+            if new != value:
+                fired.append(hit)
+                value = new
+                if final or new is None:
+                    break
+        return value, tuple(fired)
+
+    def cleaner(self, k, cache_size=None):
+        """clean for the values of k alone, behind a cache of cache_size values (None: no cache);
+        the caller adds what fired to hits, so cached values are counted every time
+        """
+        def clean(value):
+            return self.clean(k, value)
+        return lru_cache(maxsize=cache_size)(clean) if cache_size else clean
+
+    def hit_counts(self):
+        """(k, rule name, hits) of every rule in file order, including the ones that never fired"""
+        return [(k, name, self.hits[(k, name)])
+                for k, chain in self.chains.items() for (_, name), _, _ in chain]
+
+
+def compile_rules(rules, path=None):
+    """RuleSet of the rules loaded from a rule file"""
+    chains = {}
+    for k, k_rules in rules.items():
+        chain = []
+        for index, rule in enumerate(k_rules):
+            func, final = compile_rule(k, rule)
+            chain.append(((k, rule.get('name', str(index))), func, final))
+        chains[k] = chain
+    return RuleSet(chains, path)
+
+
+def print_hit_counts(ruleset):
+    for k, name, hits in ruleset.hit_counts():
+        print('{0:20} {1:20} {2:9d} hits'.format(k, name, hits))
+
+
+if __name__ == '__main__':
+    from parsers import get_element
+
+    parser = argparse.ArgumentParser(description='Count how often every cleaning rule fires on an OSM file')
+    parser.add_argument('osm_file', nargs='?', default='oc.osm')
+    parser.add_argument('--rules', default=RULES_PATH, help='rule file (default: %(default)s)')
+    args = parser.parse_args()
+
+    ruleset = load_rules(args.rules)
+    for element in get_element(args.osm_file, ('node', 'way')):
+        for tag in element.iter('tag'):
+            k = tag.attrib['k']
+            if k in ruleset:
+                ruleset.hits.update(ruleset.clean(k, tag.attrib['v'])[1])
+    print_hit_counts(ruleset)
@@ -1,34 +1,225 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+"""
+Take a small sample of an OSM file, e.g. to test the auditing code or to make
+fixtures from a multi-GB extract.
+
+Samplers (each streams the file once, keeping only the sampled elements in memory):
+- sample_every: every k-th top level element (the original behaviour); it
+  yields them as it goes, so write_sample writes them without keeping any
+- sample_reservoir: a fixed-size uniform sample of top level elements
+- sample_grid: nodes inside a bounding box, optionally stratified on a lat/lon
+  grid with a fixed number of nodes per cell, plus the ways using them
+
+close_references adds the nodes that the sampled ways point to. Nodes come
+before ways in an OSM file so this needs a second pass, which stops at the
+first way and only keeps the missing nodes.
+
+The input may be gzip, bzip2, xz or zstd compressed, and so may the sample
+if its name ends in .gz, .bz2, .xz or .zst (see compressed.py).
+"""
+
+import argparse
+import math
+import random
+from collections import namedtuple
+
 import xml.etree.ElementTree as ET  # Use cElementTree or lxml if too slow
 
+from compressed import open_input, open_output
+
 OSM_FILE = "oc.osm"  # Replace this with your osm file
 SAMPLE_FILE = "oc-sample.osm"
 
 k = 100 # Parameter: take every k-th top level element
 
+# index is the position of the element among the top level elements of the file
+Sampled = namedtuple('Sampled', ['index', 'tag', 'id', 'text', 'refs'])
+
+
 def get_element(osm_file, tags=('node', 'way', 'relation')):
     """Yield element if it is the right type of tag
 
     Reference:
     http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
     """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    with open_input(osm_file) as source:
+        context = iter(ET.iterparse(source, events=('start', 'end')))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag in tags:
+                yield elem
+                root.clear()
+
+
+def iter_elements(osm_file):
+    """Yield every top level element of osm_file, clearing the tree after each one
+    (including the ones that aren't nodes, ways or relations) so memory stays bounded
+    """
+    with open_input(osm_file) as source:
+        context = iter(ET.iterparse(source, events=('start', 'end')))
+        _, root = next(context)
+        depth = 0
+        for event, elem in context:
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 0:
+                yield elem
+                root.clear()
+
+
+def record(index, elem):
+    refs = tuple(nd.attrib['ref'] for nd in elem.iter('nd')) if elem.tag == 'way' else ()
+    return Sampled(index, elem.tag, elem.attrib.get('id'), ET.tostring(elem, encoding='unicode'), refs)
+
+
+def sample_every(osm_file, k=k, tags=('node', 'way', 'relation')):
+    """Yield every k-th element with a tag in tags, in file order"""
+    i = 0
+    for index, elem in enumerate(iter_elements(osm_file)):
+        if elem.tag in tags:
+            if i % k == 0:
+                yield record(index, elem)
+            i += 1
+
+
+class Reservoir(object):
+    """Fixed-size uniform sample of a stream (Algorithm R)"""
+
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.seen = 0
+        self.items = []
+
+    def offer(self, index, elem):
+        if self.seen < self.size:
+            self.items.append(record(index, elem))
+        else:
+            slot = self.rng.randint(0, self.seen)
+            if slot < self.size:
+                self.items[slot] = record(index, elem)
+        self.seen += 1
+
+
+def sample_reservoir(osm_file, size, tags=('node', 'way', 'relation'), seed=None):
+    """size elements with a tag in tags, each equally likely to be picked"""
+    reservoir = Reservoir(size, random.Random(seed))
+    for index, elem in enumerate(iter_elements(osm_file)):
+        if elem.tag in tags:
+            reservoir.offer(index, elem)
+    return sorted(reservoir.items)
+
+
+def in_bbox(lat, lon, bbox):
+    min_lat, min_lon, max_lat, max_lon = bbox
+    return min_lat <= lat <= max_lat and min_lon <= lon <= max_lon
+
+
+def sample_grid(osm_file, cell_size=None, per_cell=1, bbox=None, seed=None):
+    """nodes inside bbox (min_lat, min_lon, max_lat, max_lon), or anywhere if bbox is None,
+    and the ways that use at least one of them
+
+    With cell_size (in degrees) the nodes are stratified on a lat/lon grid and
+    at most per_cell nodes are kept from each cell, so dense areas don't crowd
+    out sparse ones.
+    """
+    rng = random.Random(seed)
+    cells = {}
+    nodes = []
+    node_ids = None
+    ways = []
+    for index, elem in enumerate(iter_elements(osm_file)):
+        if elem.tag == 'node':
+            lat, lon = float(elem.attrib['lat']), float(elem.attrib['lon'])
+            if bbox and not in_bbox(lat, lon, bbox):
+                continue
+            if cell_size is None:
+                nodes.append(record(index, elem))
+                continue
+            cell = (math.floor(lat / cell_size), math.floor(lon / cell_size))
+            if cell not in cells:
+                cells[cell] = Reservoir(per_cell, rng)
+            cells[cell].offer(index, elem)
+        elif elem.tag == 'way':
+            if node_ids is None:
+                # every node has been seen by the first way
+                for reservoir in cells.values():
+                    nodes.extend(reservoir.items)
+                node_ids = set(node.id for node in nodes)
+            if any(nd.attrib['ref'] in node_ids for nd in elem.iter('nd')):
+                ways.append(record(index, elem))
+    if node_ids is None:
+        for reservoir in cells.values():
+            nodes.extend(reservoir.items)
+    return sorted(nodes + ways)
+
+
+def close_references(osm_file, sampled):
+    """add the nodes referenced by sampled ways that aren't in the sample yet"""
+    sampled = list(sampled)
+    have = set(item.id for item in sampled if item.tag == 'node')
+    missing = set(ref for item in sampled for ref in item.refs if ref not in have)
+    if not missing:
+        return sampled
+
+    found = []
+    for index, elem in enumerate(iter_elements(osm_file)):
+        if elem.tag == 'node':
+            if elem.attrib['id'] in missing:
+                found.append(record(index, elem))
+        elif elem.tag in ('way', 'relation'):
+            break
+    return sorted(sampled + found)
+
+
+def write_sample(sampled, sample_file=SAMPLE_FILE):
+    """write the sampled elements (any iterable, in file order) as an OSM file"""
+    with open_output(sample_file) as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<osm>\n  ')
+        for item in sampled:
+            output.write(item.text)
+        output.write('</osm>')
+
 
+def parse_bbox(value):
+    bbox = tuple(float(x) for x in value.split(','))
+    if len(bbox) != 4:
+        raise argparse.ArgumentTypeError('expected min_lat,min_lon,max_lat,max_lon')
+    return bbox
 
-with open(SAMPLE_FILE, 'w', encoding='utf-8') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
 
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='unicode'))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sample top level elements of an OSM XML file')
+    parser.add_argument('osm_file', nargs='?', default=OSM_FILE)
+    parser.add_argument('-o', '--output', default=SAMPLE_FILE,
+                        help='sample file (default: %(default)s)')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--every', type=int, default=k, metavar='K',
+                      help='take every K-th element (default: %(default)s)')
+    mode.add_argument('--reservoir', type=int, metavar='N',
+                      help='take N elements uniformly at random')
+    mode.add_argument('--grid', type=float, metavar='DEGREES',
+                      help='stratify nodes on a lat/lon grid with this cell size')
+    parser.add_argument('--per-cell', type=int, default=1,
+                        help='nodes kept per grid cell (default: %(default)s)')
+    parser.add_argument('--bbox', type=parse_bbox, metavar='MIN_LAT,MIN_LON,MAX_LAT,MAX_LON',
+                        help='only keep nodes inside this box (and the ways using them)')
+    parser.add_argument('--closure', action='store_true',
+                        help='also take the nodes referenced by sampled ways')
+    parser.add_argument('--seed', type=int, help='random seed')
+    args = parser.parse_args()
 
-    output.write('</osm>')
\ No newline at end of file
+    if args.reservoir is not None:
+        sampled = sample_reservoir(args.osm_file, args.reservoir, seed=args.seed)
+    elif args.grid is not None or args.bbox is not None:
+        sampled = sample_grid(args.osm_file, args.grid, args.per_cell, args.bbox, seed=args.seed)
+    else:
+        sampled = sample_every(args.osm_file, args.every)
+    if args.closure:
+        sampled = close_references(args.osm_file, sampled)
+    write_sample(sampled, args.output)
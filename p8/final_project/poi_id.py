@@ -3,6 +3,7 @@
 
 import sys
 import pickle
+import numpy as np
 sys.path.append("../tools/")
 
 from feature_format import featureFormat, targetFeatureSplit
@@ -82,17 +83,12 @@ clf = GaussianNB()
 ### Generating training/testing sets
 sss = StratifiedShuffleSplit(test_size = 0.3, random_state = 47)
 
-features_train = []
-features_test = []
-labels_train = []
-labels_test = []
-for train_idx, test_idx in sss.split(features, labels):
-    for ii in train_idx:
-        features_train.append(features[ii])
-        labels_train.append(labels[ii])
-    for jj in test_idx:
-        features_test.append(features[jj])
-        labels_test.append(labels[jj])
+# the indices of every split, one after the other
+splits = list(sss.split(features, labels))
+train_idx = np.concatenate([train for train, _ in splits])
+test_idx = np.concatenate([test for _, test in splits])
+features_train, labels_train = features[train_idx], labels[train_idx]
+features_test, labels_test = features[test_idx], labels[test_idx]
 
 ### Training the classifier
 clf.fit(features_train, labels_train)
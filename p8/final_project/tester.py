@@ -12,7 +12,10 @@
 
 import pickle
 import sys
-from sklearn.cross_validation import StratifiedShuffleSplit
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.model_selection import StratifiedShuffleSplit
 sys.path.append("../tools/")
 from feature_format import featureFormat, targetFeatureSplit
 
@@ -22,43 +25,42 @@ Recall: {:>0.{display_precision}f}\tF1: {:>0.{display_precision}f}\tF2: {:>0.{di
 RESULTS_FORMAT_STRING = "\tTotal predictions: {:4d}\tTrue positives: {:4d}\tFalse positives: {:4d}\
 \tFalse negatives: {:4d}\tTrue negatives: {:4d}"
 
-def test_classifier(clf, dataset, feature_list, folds = 1000):
+def fold_confusion(clf, features, labels, train_idx, test_idx):
+    """ fit a copy of clf on one fold's training set and count its test set predictions
+        returns ([true negatives, false negatives, false positives, true positives], warned);
+        counting stops at the first prediction or label that isn't 0 or 1 (warned is then True)
+    """
+    clf = clone(clf)
+    clf.fit(features[train_idx], labels[train_idx])
+    predictions = np.asarray(clf.predict(features[test_idx]))
+    truths = labels[test_idx]
+
+    known = ((predictions == 0) | (predictions == 1)) & ((truths == 0) | (truths == 1))
+    unknown = np.flatnonzero(~known)
+    counted = unknown[0] if len(unknown) else len(predictions)
+    # 0: true negative, 1: false negative, 2: false positive, 3: true positive
+    outcomes = 2 * (predictions[:counted] == 1) + (truths[:counted] == 1)
+    return np.bincount(outcomes, minlength=4), len(unknown) > 0
+
+def test_classifier(clf, dataset, feature_list, folds = 1000, n_jobs = -1):
+    """ evaluate clf over folds stratified shuffle splits of dataset, fitted in
+        parallel over n_jobs processes (-1: one per CPU)
+    """
     data = featureFormat(dataset, feature_list, sort_keys = True)
     labels, features = targetFeatureSplit(data)
-    cv = StratifiedShuffleSplit(labels, folds, random_state = 42)
-    true_negatives = 0
-    false_negatives = 0
-    true_positives = 0
-    false_positives = 0
-    for train_idx, test_idx in cv: 
-        features_train = []
-        features_test  = []
-        labels_train   = []
-        labels_test    = []
-        for ii in train_idx:
-            features_train.append( features[ii] )
-            labels_train.append( labels[ii] )
-        for jj in test_idx:
-            features_test.append( features[jj] )
-            labels_test.append( labels[jj] )
-        
-        ### fit the classifier using training set, and test on test set
-        clf.fit(features_train, labels_train)
-        predictions = clf.predict(features_test)
-        for prediction, truth in zip(predictions, labels_test):
-            if prediction == 0 and truth == 0:
-                true_negatives += 1
-            elif prediction == 0 and truth == 1:
-                false_negatives += 1
-            elif prediction == 1 and truth == 0:
-                false_positives += 1
-            elif prediction == 1 and truth == 1:
-                true_positives += 1
-            else:
-                print("Warning: Found a predicted label not == 0 or 1.")
-                print("All predictions should take value 0 or 1.")
-                print("Evaluating performance for processed predictions:")
-                break
+    cv = StratifiedShuffleSplit(n_splits = folds, test_size = 0.1, random_state = 42)
+    results = Parallel(n_jobs = n_jobs)(
+        delayed(fold_confusion)(clf, features, labels, train_idx, test_idx)
+        for train_idx, test_idx in cv.split(features, labels))
+
+    counts = np.zeros(4, dtype=int)
+    for fold_counts, warned in results:
+        counts += fold_counts
+        if warned:
+            print("Warning: Found a predicted label not == 0 or 1.")
+            print("All predictions should take value 0 or 1.")
+            print("Evaluating performance for processed predictions:")
+    true_negatives, false_negatives, false_positives, true_positives = (int(c) for c in counts)
     try:
         total_predictions = true_negatives + false_negatives + false_positives + true_positives
         accuracy = 1.0*(true_positives + true_negatives)/total_predictions
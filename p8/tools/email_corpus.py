@@ -0,0 +1,230 @@
+#!/usr/bin/python
+
+"""
+    build the stemmed email texts (parseOutText) and author labels that
+    email_preprocess.preprocess learns from, straight from the extracted
+    Enron maildir (see startup.py)
+
+    the emails are parsed by a pool of worker processes, each reading a batch
+    of files at a time and stemming with its own cached stemmer, and written
+    as a corpus directory:
+        -- texts.txt: one stemmed email per line (utf-8)
+        -- labels.npy: the author label of every email
+        -- authors.txt: the author name of every label, one per line
+    (email_dedup.py adds canonical.npy, the canonical email of every email)
+
+    every mailbox is an author:
+        python email_corpus.py ../maildir --out corpus
+    or, as the text learning mini-project does, one author per list of email
+    paths relative to the directory holding maildir/:
+        python email_corpus.py .. --lists from_sara.txt from_chris.txt --remove sara shackleton chris germani
+
+    either can read the emails from the tarball indexed by enron_archive.py
+    instead of the extracted maildir (list paths are then archive paths):
+        python email_corpus.py --archive ../enron_mail_20150507.tar --out corpus
+
+    preprocess("corpus") then reads the corpus instead of word_data.pkl
+"""
+
+import argparse
+import os
+import time
+from functools import partial
+from multiprocessing import Pool
+
+import numpy
+
+TEXTS_FILE = "texts.txt"
+LABELS_FILE = "labels.npy"
+AUTHORS_FILE = "authors.txt"
+CANONICAL_FILE = "canonical.npy"
+
+BATCH_SIZE = 256
+
+### the EnronArchive a pool worker reads emails from, if any (see openArchive)
+ARCHIVE = None
+
+
+
+def mailboxEmails(maildir, mailboxes = None):
+    """ (author names, [(email path, label)]) of every email under maildir,
+        one author per mailbox (or only the given mailboxes), in path order
+    """
+    authors = sorted(mailboxes or [name for name in os.listdir(maildir)
+                                   if os.path.isdir(os.path.join(maildir, name))])
+    emails = []
+    for label, author in enumerate(authors):
+        for dirpath, dirnames, filenames in os.walk(os.path.join(maildir, author)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                emails.append((os.path.join(dirpath, filename), label))
+    return authors, emails
+
+
+def listedEmails(root, list_files):
+    """ (author names, [(email path, label)]) of the emails in list_files, one
+        author per list; a list holds an email path relative to root per line
+    """
+    authors = [os.path.splitext(os.path.basename(list_file))[0] for list_file in list_files]
+    emails = []
+    for label, list_file in enumerate(list_files):
+        with open(list_file, "r") as paths:
+            for path in paths:
+                path = path.strip()
+                if path:
+                    emails.append((os.path.join(root, path), label))
+    return authors, emails
+
+
+def archiveEmails(archive, mailboxes = None):
+    """ mailboxEmails for the maildir/ files of an EnronArchive """
+    by_mailbox = {}
+    for name in archive.names():
+        parts = name.split("/")
+        if len(parts) > 2 and parts[0] == "maildir":
+            by_mailbox.setdefault(parts[1], []).append(name)
+    authors = sorted(mailboxes or by_mailbox)
+    emails = [(name, label) for label, author in enumerate(authors)
+              for name in sorted(by_mailbox.get(author, []))]
+    return authors, emails
+
+
+def openArchive(tar_path):
+    """ pool worker initializer: read emails from the indexed tar at tar_path """
+    global ARCHIVE
+    if tar_path is not None:
+        from enron_archive import EnronArchive
+        ARCHIVE = EnronArchive(tar_path)
+
+
+def readEmail(path):
+    if ARCHIVE is not None:
+        return ARCHIVE.read(path)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def parseBatch(paths, remove = frozenset()):
+    """ parseOutString of every email in paths, without the words in remove """
+    ### imported here: reading a corpus (email_preprocess) doesn't need nltk
+    from parse_out_email_text import parseOutString
+
+    texts = []
+    for path in paths:
+        text = parseOutString(readEmail(path).decode("utf-8", "replace"))
+        if remove:
+            text = " ".join(word for word in text.split() if word not in remove)
+        texts.append(text)
+    return texts
+
+
+def buildCorpus(authors, emails, corpus_dir, workers = None, batch_size = BATCH_SIZE, remove = (),
+                archive_path = None):
+    """ parse emails ([(path, label)]) over workers processes (None: one per CPU)
+        and write them with their labels and authors to corpus_dir; the paths
+        are in the indexed tar at archive_path if given;
+        returns the number of emails written
+    """
+    if not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+    paths = [path for path, _ in emails]
+    batches = [paths[start:start + batch_size] for start in range(0, len(paths), batch_size)]
+
+    pool = Pool(workers, openArchive, (archive_path,))
+    try:
+        with open(os.path.join(corpus_dir, TEXTS_FILE), "w", encoding="utf-8", newline="\n") as texts:
+            ### imap keeps the batches in order, so line i is emails[i]
+            for batch in pool.imap(partial(parseBatch, remove=frozenset(remove)), batches):
+                for text in batch:
+                    texts.write(text + "\n")
+    finally:
+        pool.close()
+        pool.join()
+
+    numpy.save(os.path.join(corpus_dir, LABELS_FILE),
+               numpy.array([label for _, label in emails], dtype=numpy.int32))
+    with open(os.path.join(corpus_dir, AUTHORS_FILE), "w", encoding="utf-8") as f:
+        for author in authors:
+            f.write(author + "\n")
+    return len(emails)
+
+
+def isCorpus(path):
+    return os.path.isfile(os.path.join(path, TEXTS_FILE))
+
+
+def corpusFiles(corpus_dir):
+    return [os.path.join(corpus_dir, name) for name in (TEXTS_FILE, LABELS_FILE, AUTHORS_FILE)]
+
+
+def readCorpus(corpus_dir):
+    """ (texts, labels) lists of a corpus written by buildCorpus """
+    with open(os.path.join(corpus_dir, TEXTS_FILE), "r", encoding="utf-8", newline="\n") as f:
+        texts = [line[:-1] for line in f]
+    labels = numpy.load(os.path.join(corpus_dir, LABELS_FILE)).tolist()
+    return texts, labels
+
+
+def corpusLabels(corpus_dir):
+    """ the labels of a corpus, memory-mapped """
+    return numpy.load(os.path.join(corpus_dir, LABELS_FILE), mmap_mode="r")
+
+
+def readCanonical(corpus_dir):
+    """ canonical email index of every email of a corpus (email_dedup.py), memory-mapped,
+        or None if it hasn't been deduplicated
+    """
+    path = os.path.join(corpus_dir, CANONICAL_FILE)
+    if not os.path.isfile(path):
+        return None
+    return numpy.load(path, mmap_mode="r")
+
+
+def iterCorpus(corpus_dir, chunk_size):
+    """ yield (texts, labels) lists of chunk_size emails of a corpus at a time """
+    labels = corpusLabels(corpus_dir)
+    start = 0
+    texts = []
+    with open(os.path.join(corpus_dir, TEXTS_FILE), "r", encoding="utf-8", newline="\n") as f:
+        for line in f:
+            texts.append(line[:-1])
+            if len(texts) == chunk_size:
+                yield texts, labels[start:start + len(texts)].tolist()
+                start += len(texts)
+                texts = []
+    if texts:
+        yield texts, labels[start:start + len(texts)].tolist()
+
+
+def readAuthors(corpus_dir):
+    """ author name of every label of a corpus """
+    with open(os.path.join(corpus_dir, AUTHORS_FILE), "r", encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f]
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build a stemmed email corpus from the Enron maildir")
+    parser.add_argument("maildir", nargs="?", default="../maildir",
+                        help="maildir, or the directory holding it with --lists (default: %(default)s)")
+    parser.add_argument("--archive", help="indexed Enron tar (enron_archive.py) to read instead of maildir")
+    parser.add_argument("--out", default="corpus", help="corpus directory (default: %(default)s)")
+    parser.add_argument("--mailboxes", nargs="+", help="only these mailboxes (default: all)")
+    parser.add_argument("--lists", nargs="+", help="email path lists, one per author")
+    parser.add_argument("--remove", nargs="+", default=[], help="stemmed words to leave out (e.g. signatures)")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: one per CPU)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="emails per task")
+    args = parser.parse_args()
+
+    if args.lists:
+        authors, emails = listedEmails("" if args.archive else args.maildir, args.lists)
+    elif args.archive:
+        from enron_archive import EnronArchive
+        with EnronArchive(args.archive) as archive:
+            authors, emails = archiveEmails(archive, args.mailboxes)
+    else:
+        authors, emails = mailboxEmails(args.maildir, args.mailboxes)
+    start = time.time()
+    count = buildCorpus(authors, emails, args.out, args.workers, args.batch_size, args.remove, args.archive)
+    print("{0} emails of {1} authors written to {2} in {3:.1f} s".format(
+        count, len(authors), args.out, time.time() - start))
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+"""
+    find near-duplicate emails (forwards, replies quoting a whole thread, the
+    same message in several folders) so they are vectorized and learned from once
+
+    every stemmed email is cut into shingles of SHINGLE_SIZE consecutive words,
+    summarized by a MinHash signature of NUM_PERM hashes (the fraction of equal
+    hashes estimates the Jaccard similarity of two emails' shingles) and the
+    signatures are split into BANDS bands: emails sharing a band are candidates,
+    and candidates whose estimated similarity is at least threshold are merged,
+    so no pair of emails is ever compared outright
+
+    the result is the canonical email of every email, the first of its group:
+        python email_dedup.py corpus --threshold 0.8
+    writes corpus/canonical.npy, which preprocess(..., dedup=True) and the
+    streaming functions of email_preprocess use to keep the canonical emails only
+"""
+
+import argparse
+import os
+import time
+import zlib
+from functools import lru_cache
+
+import numpy
+
+from email_corpus import CANONICAL_FILE, iterCorpus
+
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+BANDS = 16
+THRESHOLD = 0.8
+CHUNK_SIZE = 1000
+
+### hashes are taken modulo a Mersenne prime small enough for a * x + b to fit in uint64
+PRIME = (1 << 31) - 1
+SHINGLE_BASE = 1000003
+SEED = 1
+
+_random = numpy.random.RandomState(SEED)
+PERM_A = _random.randint(1, PRIME, NUM_PERM).astype(numpy.uint64)
+PERM_B = _random.randint(0, PRIME, NUM_PERM).astype(numpy.uint64)
+
+
+
+@lru_cache(maxsize=1 << 20)
+def wordHash(word):
+    return zlib.crc32(word.encode("utf-8")) % PRIME
+
+
+def shingleHashes(text, shingle_size = SHINGLE_SIZE):
+    """ distinct hashes of the shingle_size word shingles of text (a text with
+        fewer words is one shingle)
+    """
+    words = numpy.array([wordHash(word) for word in text.split()], dtype=numpy.uint64)
+    count = max(len(words) - shingle_size + 1, min(len(words), 1))
+    hashes = numpy.zeros(count, dtype=numpy.uint64)
+    for offset in range(min(shingle_size, len(words))):
+        hashes = (hashes * numpy.uint64(SHINGLE_BASE) + words[offset:offset + count]) % numpy.uint64(PRIME)
+    return numpy.unique(hashes)
+
+
+def signature(text, shingle_size = SHINGLE_SIZE):
+    """ MinHash signature (NUM_PERM uint32) of text; an empty text's is all PRIME """
+    hashes = shingleHashes(text, shingle_size)
+    if not len(hashes):
+        return numpy.full(NUM_PERM, PRIME, dtype=numpy.uint32)
+    permuted = (PERM_A[:, None] * hashes[None, :] + PERM_B[:, None]) % numpy.uint64(PRIME)
+    return permuted.min(axis=1).astype(numpy.uint32)
+
+
+def signatures(texts, shingle_size = SHINGLE_SIZE):
+    """ (len(texts), NUM_PERM) array of MinHash signatures """
+    result = numpy.empty((len(texts), NUM_PERM), dtype=numpy.uint32)
+    for i, text in enumerate(texts):
+        result[i] = signature(text, shingle_size)
+    return result
+
+
+def findDuplicates(sigs, bands = BANDS, threshold = THRESHOLD):
+    """ canonical email index of every email, by LSH over their signatures:
+        emails sharing a band whose signatures agree on at least threshold of
+        their hashes are grouped, and a group's canonical email is its first
+    """
+    n, num_perm = sigs.shape
+    rows = num_perm // bands
+    parent = numpy.arange(n)
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(bands):
+        buckets = {}
+        keys = numpy.ascontiguousarray(sigs[:, band * rows:(band + 1) * rows])
+        for i in range(n):
+            members = buckets.setdefault(keys[i].tobytes(), [])
+            for j in members:
+                if root(i) == root(j):
+                    break
+                if numpy.count_nonzero(sigs[i] == sigs[j]) >= threshold * num_perm:
+                    ### the smaller index stays the root, so the root is the first email
+                    a, b = root(i), root(j)
+                    parent[max(a, b)] = min(a, b)
+                    break
+            else:
+                members.append(i)
+
+    return numpy.array([root(i) for i in range(n)])
+
+
+def dedupCorpus(corpus_dir, threshold = THRESHOLD, bands = BANDS, shingle_size = SHINGLE_SIZE,
+                chunk_size = CHUNK_SIZE):
+    """ find the near-duplicates of a corpus and write its canonical.npy;
+        returns the canonical index array
+    """
+    sigs = numpy.concatenate([signatures(texts, shingle_size)
+                              for texts, _ in iterCorpus(corpus_dir, chunk_size)] or
+                             [numpy.empty((0, NUM_PERM), dtype=numpy.uint32)])
+    canonical = findDuplicates(sigs, bands, threshold)
+    path = os.path.join(corpus_dir, CANONICAL_FILE)
+    with open(path + ".tmp", "wb") as f:
+        numpy.save(f, canonical)
+    os.replace(path + ".tmp", path)
+    return canonical
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find near-duplicate emails of a corpus (email_corpus.py)")
+    parser.add_argument("corpus", nargs="?", default="corpus")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="estimated Jaccard similarity of duplicates (default: %(default)s)")
+    parser.add_argument("--bands", type=int, default=BANDS, help="LSH bands (default: %(default)s)")
+    parser.add_argument("--shingle-size", type=int, default=SHINGLE_SIZE, help="words per shingle")
+    args = parser.parse_args()
+
+    start = time.time()
+    canonical = dedupCorpus(args.corpus, args.threshold, args.bands, args.shingle_size)
+    distinct = numpy.count_nonzero(canonical == numpy.arange(len(canonical)))
+    print("{0} emails, {1} distinct, {2} near-duplicates found in {3:.1f} s".format(
+        len(canonical), distinct, len(canonical) - distinct, time.time() - start))
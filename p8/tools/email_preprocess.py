@@ -1,51 +1,114 @@
 #!/usr/bin/python
 
-import pickle
+import hashlib
+import os
 import pickle
 import numpy
 
-from sklearn import cross_validation
-from sklearn.feature_extraction.text import TfidfVectorizer
+import sklearn
+from sklearn.model_selection import train_test_split
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfVectorizer
 from sklearn.feature_selection import SelectPercentile, f_classif
+from sklearn.preprocessing import normalize
 
+from email_corpus import CANONICAL_FILE, corpusFiles, corpusLabels, isCorpus, iterCorpus, readCanonical, readCorpus
+from email_dedup import dedupCorpus, findDuplicates, signatures
 
+### fitted features are cached per user, outside the source tree
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                         "email_preprocess")
 
-def preprocess(words_file = "../tools/word_data.pkl", authors_file="../tools/email_authors.pkl"):
-    """ 
-        this function takes a pre-made list of email texts (by default word_data.pkl)
-        and the corresponding authors (by default email_authors.pkl) and performs
-        a number of preprocessing steps:
-            -- splits into training/testing sets (10% testing)
-            -- vectorizes into tfidf matrix
-            -- selects/keeps most helpful features
+### everything the fitted features depend on besides the input files
+PARAMETERS = {"test_size": 0.1, "random_state": 42,
+              "vectorizer": {"sublinear_tf": True, "max_df": 0.5, "stop_words": "english"},
+              "percentile": 1,
+              "sklearn": sklearn.__version__}
 
-        after this, the feaures and labels are put into numpy arrays, which play nice with sklearn functions
+### streaming mode: emails per chunk, and hashed features (instead of a vocabulary)
+CHUNK_SIZE = 1000
+HASH_FEATURES = 1 << 20
+
+
+
+def fileDigest(path, block_size = 1 << 20):
+    """ sha256 hex digest of the contents of the file at path """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def inputFiles(words_file, authors_file, dedup = False):
+    """ the files the emails and their authors are read from """
+    if isCorpus(words_file):
+        files = corpusFiles(words_file)
+        if dedup and readCanonical(words_file) is not None:
+            files.append(os.path.join(words_file, CANONICAL_FILE))
+        return files
+    return [words_file, authors_file]
+
+
+def canonicalEmails(words_file, word_data):
+    """ canonical email index of every email: the corpus's canonical.npy if it
+        has one, otherwise found by email_dedup
+    """
+    canonical = readCanonical(words_file) if isCorpus(words_file) else None
+    if canonical is None:
+        canonical = findDuplicates(signatures(word_data))
+    return canonical
+
+
+def loadEmails(words_file, authors_file, dedup = False):
+    """ (email texts, author labels) from the two pickles, or from the corpus
+        directory words_file (see email_corpus.py); with dedup=True only the
+        canonical emails of their near-duplicates (see email_dedup.py)
+    """
+    if isCorpus(words_file):
+        word_data, authors = readCorpus(words_file)
+    else:
+        authors_file_handler = open(authors_file, "rb")
+        authors = pickle.load(authors_file_handler)
+        authors_file_handler.close()
+
+        words_file_handler = open(words_file, "rb")
+        word_data = pickle.load(words_file_handler)
+        words_file_handler.close()
+
+    if dedup:
+        canonical = canonicalEmails(words_file, word_data)
+        keep = numpy.flatnonzero(canonical == numpy.arange(len(canonical)))
+        word_data, authors = [word_data[i] for i in keep], [authors[i] for i in keep]
+    return word_data, authors
+
+
+def cachePath(cache_dir, words_file, authors_file, dedup = False):
+    """ cache file for the input files' contents, dedup and PARAMETERS """
+    key = hashlib.sha256()
+    digests = [fileDigest(path) for path in inputFiles(words_file, authors_file, dedup)]
+    for part in digests + ["dedup" if dedup else "", repr(sorted(PARAMETERS.items()))]:
+        key.update(part.encode("utf-8"))
+    return os.path.join(cache_dir, key.hexdigest() + ".pkl")
 
-        4 objects are returned:
-            -- training/testing features
-            -- training/testing labels
 
+def fitFeatures(words_file, authors_file, dedup = False):
+    """ split, vectorize and select features of the emails as preprocess describes;
+        returns a dict of the fitted vectorizer and selector, the sparse (CSR)
+        training/testing features and the training/testing labels
     """
 
     ### the words (features) and authors (labels), already largely preprocessed
     ### this preprocessing will be repeated in the text learning mini-project
-    authors_file_handler = open(authors_file, "rb")
-    authors = pickle.load(authors_file_handler)
-    authors_file_handler.close()
-
-    words_file_handler = open(words_file, "rb")
-    word_data = pickle.load(words_file_handler)
-    words_file_handler.close()
+    word_data, authors = loadEmails(words_file, authors_file, dedup)
 
     ### test_size is the percentage of events assigned to the test set
     ### (remainder go into training)
-    features_train, features_test, labels_train, labels_test = cross_validation.train_test_split(word_data, authors, test_size=0.1, random_state=42)
+    features_train, features_test, labels_train, labels_test = train_test_split(word_data, authors, test_size=PARAMETERS["test_size"], random_state=PARAMETERS["random_state"])
 
 
 
     ### text vectorization--go from strings to lists of numbers
-    vectorizer = TfidfVectorizer(sublinear_tf=True, max_df=0.5,
-                                 stop_words='english')
+    vectorizer = TfidfVectorizer(**PARAMETERS["vectorizer"])
     features_train_transformed = vectorizer.fit_transform(features_train)
     features_test_transformed  = vectorizer.transform(features_test)
 
@@ -53,13 +116,210 @@ def preprocess(words_file = "../tools/word_data.pkl", authors_file="../tools/ema
 
     ### feature selection, because text is super high dimensional and 
     ### can be really computationally chewy as a result
-    selector = SelectPercentile(f_classif, percentile=1)
+    selector = SelectPercentile(f_classif, percentile=PARAMETERS["percentile"])
     selector.fit(features_train_transformed, labels_train)
-    features_train_transformed = selector.transform(features_train_transformed).toarray()
-    features_test_transformed  = selector.transform(features_test_transformed).toarray()
+
+    return {"vectorizer": vectorizer, "selector": selector,
+            "features_train": selector.transform(features_train_transformed).tocsr(),
+            "features_test": selector.transform(features_test_transformed).tocsr(),
+            "labels_train": labels_train, "labels_test": labels_test}
+
+
+def loadFeatures(words_file, authors_file, cache_dir = CACHE_DIR, dedup = False):
+    """ fitFeatures, read from cache_dir if these input files and PARAMETERS
+        were fitted before, written there otherwise (cache_dir None: no cache)
+    """
+    if cache_dir is None:
+        return fitFeatures(words_file, authors_file, dedup)
+
+    path = cachePath(cache_dir, words_file, authors_file, dedup)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    fitted = fitFeatures(words_file, authors_file, dedup)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    ### written aside and renamed, so an interrupted run never leaves half a cache file
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(fitted, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+    return fitted
+
+
+def preprocess(words_file = "../tools/word_data.pkl", authors_file="../tools/email_authors.pkl",
+               sparse = False, cache_dir = CACHE_DIR, return_fitted = False, dedup = False):
+    """ 
+        this function takes a pre-made list of email texts (by default word_data.pkl)
+        and the corresponding authors (by default email_authors.pkl) and performs
+        a number of preprocessing steps:
+            -- splits into training/testing sets (10% testing)
+            -- vectorizes into tfidf matrix
+            -- selects/keeps most helpful features
+
+        words_file may also be a corpus directory built by email_corpus.py,
+        which holds the authors too (authors_file is then not read)
+
+        with dedup=True near-duplicate emails are left out before splitting,
+        keeping the first of each group (see email_dedup.py)
+
+        after this, the feaures and labels are put into numpy arrays, which play nice with sklearn functions
+
+        4 objects are returned:
+            -- training/testing features
+            -- training/testing labels
+
+        with sparse=True the features stay scipy CSR matrices instead of dense
+        numpy arrays; return_fitted=True also returns the fitted vectorizer and
+        selector (6 objects)
+
+        the fitted result is cached in cache_dir, keyed by the contents of the
+        input files and PARAMETERS, so later calls skip the fitting
+        (cache_dir=None: always refit)
+
+    """
+
+    fitted = loadFeatures(words_file, authors_file, cache_dir, dedup)
+    features_train_transformed = fitted["features_train"]
+    features_test_transformed  = fitted["features_test"]
+    labels_train = fitted["labels_train"]
+    labels_test = fitted["labels_test"]
+    if not sparse:
+        features_train_transformed = features_train_transformed.toarray()
+        features_test_transformed  = features_test_transformed.toarray()
 
     ### info on the data
     print("no. of Chris training emails:", sum(labels_train))
     print("no. of Sara training emails:", len(labels_train)-sum(labels_train))
     
+    if return_fitted:
+        return features_train_transformed, features_test_transformed, labels_train, labels_test, fitted["vectorizer"], fitted["selector"]
     return features_train_transformed, features_test_transformed, labels_train, labels_test
+
+
+
+### streaming mode, for corpora too big to vectorize in one go: emails are
+### read, vectorized and learned from a chunk at a time, so memory is bounded
+### by the chunk size (given a corpus directory; the pickles are loaded whole)
+###
+###     clf, vectorizer = streamTrain(SGDClassifier(), "corpus")
+###     print(streamScore(clf, vectorizer, "corpus"))
+
+def streamEmails(words_file = "../tools/word_data.pkl", authors_file = "../tools/email_authors.pkl",
+                 chunk_size = CHUNK_SIZE, dedup = False):
+    """ yield (email texts, author labels) lists of chunk_size emails at a time
+        (fewer with dedup=True, which leaves out near-duplicates as loadEmails
+        does; a corpus is deduplicated by email_dedup.dedupCorpus first if it
+        hasn't been yet)
+    """
+    if isCorpus(words_file):
+        canonical = None
+        if dedup:
+            canonical = readCanonical(words_file)
+            if canonical is None:
+                canonical = dedupCorpus(words_file)
+        start = 0
+        for texts, labels in iterCorpus(words_file, chunk_size):
+            if canonical is not None:
+                keep = numpy.flatnonzero(canonical[start:start + len(texts)] == numpy.arange(start, start + len(texts)))
+                start += len(texts)
+                texts, labels = [texts[i] for i in keep], [labels[i] for i in keep]
+            yield texts, labels
+        return
+    word_data, authors = loadEmails(words_file, authors_file, dedup)
+    for start in range(0, len(word_data), chunk_size):
+        yield word_data[start:start + chunk_size], authors[start:start + chunk_size]
+
+
+def streamClasses(words_file = "../tools/word_data.pkl", authors_file = "../tools/email_authors.pkl"):
+    """ the distinct author labels, which partial_fit needs up front """
+    if isCorpus(words_file):
+        return numpy.unique(corpusLabels(words_file))
+    authors_file_handler = open(authors_file, "rb")
+    authors = pickle.load(authors_file_handler)
+    authors_file_handler.close()
+    return numpy.unique(authors)
+
+
+def streamSplit(words_file = "../tools/word_data.pkl", authors_file = "../tools/email_authors.pkl",
+                chunk_size = CHUNK_SIZE, test = False, test_size = PARAMETERS["test_size"],
+                random_state = PARAMETERS["random_state"], dedup = False):
+    """ streamEmails, keeping the training emails (or with test=True, the testing
+        emails): each email is drawn into the test set with probability test_size,
+        the same emails whatever the chunk size
+    """
+    random = numpy.random.RandomState(random_state)
+    for texts, labels in streamEmails(words_file, authors_file, chunk_size, dedup):
+        in_test = random.random_sample(len(texts)) < test_size
+        keep = numpy.flatnonzero(in_test == test)
+        yield [texts[i] for i in keep], [labels[i] for i in keep]
+
+
+class StreamingTfidf(object):
+    """ TfidfVectorizer (smooth idf, l2 norm) over hashed features, with the
+        document frequencies counted chunk by chunk by partial_fit;
+        features in more than max_df (a fraction, or a count if an int) of the
+        documents are dropped like TfidfVectorizer's max_df
+    """
+
+    def __init__(self, n_features = HASH_FEATURES, sublinear_tf = PARAMETERS["vectorizer"]["sublinear_tf"],
+                 max_df = PARAMETERS["vectorizer"]["max_df"], stop_words = PARAMETERS["vectorizer"]["stop_words"]):
+        self.hasher = HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None,
+                                        stop_words=stop_words)
+        self.sublinear_tf = sublinear_tf
+        self.max_df = max_df
+        self.document_counts = numpy.zeros(n_features, dtype=numpy.int64)
+        self.n_documents = 0
+        self.idf = None
+
+    def partial_fit(self, texts):
+        counts = self.hasher.transform(texts)
+        ### a row's indices are distinct, so counting them counts documents
+        self.document_counts += numpy.bincount(counts.indices, minlength=len(self.document_counts))
+        self.n_documents += counts.shape[0]
+        self.idf = None
+        return self
+
+    def inverseDocumentFrequencies(self):
+        if self.idf is None:
+            self.idf = numpy.log((1.0 + self.n_documents) / (1.0 + self.document_counts)) + 1.0
+            limit = self.max_df if isinstance(self.max_df, int) else self.max_df * self.n_documents
+            self.idf[self.document_counts > limit] = 0.0
+        return self.idf
+
+    def transform(self, texts):
+        """ CSR tf-idf matrix of texts """
+        features = self.hasher.transform(texts)
+        if self.sublinear_tf:
+            numpy.log(features.data, out=features.data)
+            features.data += 1.0
+        features.data *= self.inverseDocumentFrequencies()[features.indices]
+        features.eliminate_zeros()
+        return normalize(features, copy=False)
+
+
+def streamTrain(clf, words_file = "../tools/word_data.pkl", authors_file = "../tools/email_authors.pkl",
+                chunk_size = CHUNK_SIZE, vectorizer = None, **split):
+    """ train clf (anything with partial_fit) on the training emails in two
+        streaming passes: document frequencies first, then clf chunk by chunk;
+        split is passed on to streamSplit; returns (clf, fitted StreamingTfidf)
+    """
+    vectorizer = vectorizer or StreamingTfidf()
+    for texts, labels in streamSplit(words_file, authors_file, chunk_size, **split):
+        vectorizer.partial_fit(texts)
+    classes = streamClasses(words_file, authors_file)
+    for texts, labels in streamSplit(words_file, authors_file, chunk_size, **split):
+        if texts:
+            clf.partial_fit(vectorizer.transform(texts), labels, classes=classes)
+    return clf, vectorizer
+
+
+def streamScore(clf, vectorizer, words_file = "../tools/word_data.pkl", authors_file = "../tools/email_authors.pkl",
+                chunk_size = CHUNK_SIZE, **split):
+    """ accuracy of a streamTrain'ed clf on the testing emails """
+    correct = total = 0
+    for texts, labels in streamSplit(words_file, authors_file, chunk_size, test=True, **split):
+        if texts:
+            correct += numpy.count_nonzero(clf.predict(vectorizer.transform(texts)) == numpy.asarray(labels))
+            total += len(texts)
+    return float(correct) / total if total else 0.0
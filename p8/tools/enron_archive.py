@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+"""
+    random access to the emails of the Enron tarball without extracting its
+    half a million files
+
+    indexing (once) decompresses enron_mail_20150507.tar.gz into a plain tar
+    next to it and writes an index of where every member's bytes are in it:
+        python enron_archive.py ../enron_mail_20150507.tar.gz
+    (startup.py --index does this instead of extracting)
+
+    an EnronArchive then memory-maps the tar and returns an email's bytes by
+    its path in the tarball, e.g. maildir/bailey-s/deleted_items/101.:
+        archive = EnronArchive("../enron_mail_20150507.tar")
+        text = parseOutText(archive.openText("maildir/bailey-s/deleted_items/101."))
+
+    the index (<tar>.idx) has an "offset<TAB>size<TAB>path" line per file
+"""
+
+import argparse
+import gzip
+import io
+import mmap
+import os
+import shutil
+import tarfile
+import time
+
+INDEX_SUFFIX = ".idx"
+
+
+
+def archivePath(tar_gz_path):
+    """ the plain tar a tar.gz is decompressed into """
+    for suffix in (".tar.gz", ".tgz"):
+        if tar_gz_path.endswith(suffix):
+            return tar_gz_path[:-len(suffix)] + ".tar"
+    return tar_gz_path + ".tar"
+
+
+def memberPath(name):
+    """ member name or email path in the form the index keys them by """
+    while name.startswith("./"):
+        name = name[2:]
+    return name
+
+
+def indexArchive(tar_path, index_path = None):
+    """ write the index of the regular files in an uncompressed tar;
+        returns the number of files indexed
+    """
+    index_path = index_path or tar_path + INDEX_SUFFIX
+    count = 0
+    with tarfile.open(tar_path, "r:") as tar, open(index_path + ".tmp", "w", encoding="utf-8") as index:
+        while True:
+            member = tar.next()
+            if member is None:
+                break
+            ### next() only reads headers (the data is seeked over) and keeps every
+            ### member it read, which isn't needed once indexed
+            tar.members = []
+            if member.isfile():
+                index.write("{0}\t{1}\t{2}\n".format(member.offset_data, member.size, memberPath(member.name)))
+                count += 1
+    os.replace(index_path + ".tmp", index_path)
+    return count
+
+
+def buildArchive(tar_gz_path, tar_path = None, index_path = None):
+    """ decompress a tar.gz into a plain tar (default: archivePath) and index it;
+        returns (tar path, number of files indexed)
+    """
+    tar_path = tar_path or archivePath(tar_gz_path)
+    with gzip.open(tar_gz_path, "rb") as source, open(tar_path + ".tmp", "wb") as target:
+        shutil.copyfileobj(source, target, 1 << 20)
+    os.replace(tar_path + ".tmp", tar_path)
+    return tar_path, indexArchive(tar_path, index_path)
+
+
+class EnronArchive(object):
+    """ the files of an indexed, uncompressed tar, read through a memory map """
+
+    def __init__(self, tar_path, index_path = None):
+        self.index = {}
+        with open(index_path or tar_path + INDEX_SUFFIX, "r", encoding="utf-8") as index:
+            for line in index:
+                offset, size, name = line.rstrip("\n").split("\t", 2)
+                self.index[name] = (int(offset), int(size))
+        self.file = open(tar_path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return memberPath(path) in self.index
+
+    def names(self):
+        """ paths of the files in the archive, in archive order """
+        return list(self.index)
+
+    def read(self, path):
+        """ the bytes of the file at path (KeyError if there's none) """
+        offset, size = self.index[memberPath(path)]
+        return self.map[offset:offset + size]
+
+    def openText(self, path, encoding = "utf-8"):
+        """ the file at path as a text file object, e.g. for parseOutText """
+        return io.StringIO(self.read(path).decode(encoding, "replace"))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Decompress and index the Enron tarball for random access")
+    parser.add_argument("tarball", nargs="?", default="../enron_mail_20150507.tar.gz")
+    parser.add_argument("--tar", default=None, help="plain tar to write (default: next to the tarball)")
+    args = parser.parse_args()
+
+    start = time.time()
+    tar_path, count = buildArchive(args.tarball, args.tar)
+    print("{0} files of {1} indexed in {2:.1f} s".format(count, tar_path, time.time() - start))
@@ -31,6 +31,11 @@
 """
 
 
+import argparse
+import random
+import time
+from operator import itemgetter
+
 import numpy as np
 
 def featureFormat( dictionary, features, remove_NaN=True, remove_all_zeroes=True, remove_any_zeroes=False, sort_keys = False):
@@ -49,6 +54,58 @@ def featureFormat( dictionary, features, remove_NaN=True, remove_all_zeroes=True
     """
 
 
+    # Key order - first branch is for Python 3 compatibility on mini-projects,
+    # second branch is for compatibility on final project.
+    if isinstance(sort_keys, str):
+        import pickle
+        keys = pickle.load(open(sort_keys, "rb"))
+    elif sort_keys:
+        keys = sorted(dictionary.keys())
+    else:
+        keys = list(dictionary.keys())
+
+    ### one (n x k) object array of the raw values, fetched a row at a time
+    get = itemgetter(*features)
+    try:
+        if len(features) == 1:
+            rows = [(get(dictionary[key]),) for key in keys]
+        else:
+            rows = [get(dictionary[key]) for key in keys]
+    except KeyError:
+        missing = next(feature for key in keys for feature in features
+                       if key not in dictionary or feature not in dictionary[key])
+        print("error: key ", missing, " not present")
+        return
+    if not rows:
+        return np.array([])
+    values = np.empty((len(rows), len(features)), dtype=object)
+    values[:] = rows
+
+    ### only the "NaN" strings become 0, float() turns the rest into float64
+    if remove_NaN:
+        values[values == "NaN"] = 0
+    data = values.astype(np.float64)
+
+    # exclude 'poi' class as criteria.
+    test = data[:, 1:] if features[0] == 'poi' else data
+    keep = np.ones(len(data), dtype=bool)
+    ### drop data points whose features are all zero (NaN counts as non-zero)
+    if remove_all_zeroes:
+        keep &= (test != 0).any(axis=1)
+    ### drop data points with any zero feature
+    if remove_any_zeroes:
+        keep &= ~(test == 0).any(axis=1)
+
+    if keep.all():
+        return data
+    if not keep.any():
+        return np.array([])
+    return data[keep]
+
+
+def featureFormatReference( dictionary, features, remove_NaN=True, remove_all_zeroes=True, remove_any_zeroes=False, sort_keys = False):
+    """ original one value at a time implementation of featureFormat, kept to check against """
+
     return_list = []
 
     # Key order - first branch is for Python 3 compatibility on mini-projects,
@@ -106,23 +163,64 @@ def targetFeatureSplit( data ):
     """ 
         given a numpy array like the one returned from
         featureFormat, separate out the first feature
-        and put it into its own list (this should be the 
+        and put it into its own vector (this should be the 
         quantity you want to predict)
 
-        return targets and features as separate lists
+        return targets as a contiguous 1-d array and features
+        as a view of the other columns of data (no copy), so
+        train/test sets can be taken with fancy indexing:
 
-        (sklearn can generally handle both lists and numpy arrays as 
-        input formats when training/predicting)
+        labels_train, features_train = labels[train_idx], features[train_idx]
     """
 
-    target = []
-    features = []
-    for item in data:
-        target.append( item[0] )
-        features.append( item[1:] )
+    if len(data) == 0:
+        return np.empty(0), np.empty((0, 0))
+    return np.ascontiguousarray(data[:, 0]), data[:, 1:]
+
 
-    return target, features
+def scaledDataset( dictionary, people, seed=0 ):
+    """ dictionary resampled with replacement to people people, e.g. to time featureFormat """
 
+    rng = random.Random(seed)
+    names = sorted(dictionary.keys())
+    scaled = {}
+    for i in range(people):
+        name = rng.choice(names)
+        scaled["{0} {1}".format(name, i)] = dict(dictionary[name])
+    return scaled
 
 
+def benchmark( dataset_file="../final_project/final_project_dataset.pkl", people=100000, repeat=3 ):
+    """ time featureFormat against featureFormatReference on the final project dataset
+        scaled to people people, checking they give the same array
+    """
 
+    import pickle
+    with open(dataset_file, "rb") as data_file:
+        dictionary = scaledDataset(pickle.load(data_file), people)
+    features = ["poi"] + sorted(f for f in next(iter(dictionary.values())) if f not in ("poi", "email_address"))
+
+    for options in ({}, {"remove_any_zeroes": True}, {"remove_NaN": False}):
+        timings = []
+        results = []
+        for func in (featureFormatReference, featureFormat):
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = func(dictionary, features, **options)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings.append(best)
+            results.append(result)
+        assert results[0].shape == results[1].shape and np.array_equal(results[0], results[1], equal_nan=True), options
+        print("{0:28} {1} rows  loop {2:7.3f} s  vectorized {3:7.3f} s  {4:5.1f}x".format(
+            str(options or "defaults"), results[1].shape, timings[0], timings[1], timings[0] / timings[1]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark featureFormat on a scaled up final project dataset")
+    parser.add_argument("--dataset", default="../final_project/final_project_dataset.pkl")
+    parser.add_argument("--people", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    benchmark(args.dataset, args.people, args.repeat)
@@ -1,8 +1,19 @@
 #!/usr/bin/python
 
+from functools import lru_cache
 from nltk.stem.snowball import SnowballStemmer
 import string
 
+### one stemmer per process, and each distinct word stemmed once: the
+### vocabulary is tiny next to the number of words in the Enron emails
+STEMMER = SnowballStemmer("english")
+STEM_CACHE_SIZE = 1 << 20
+PUNCTUATION = str.maketrans("", "", string.punctuation)
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def stemWord(word):
+    return STEMMER.stem(word)
+
 def parseOutText(f):
     """ given an opened email file f, parse out all text below the
         metadata block at the top
@@ -18,14 +29,17 @@ def parseOutText(f):
 
 
     f.seek(0)  ### go back to beginning of file (annoying)
-    all_text = f.read()
+    return parseOutString(f.read())
+
+def parseOutString(all_text):
+    """ parseOutText for the whole text of an email already read in """
 
     ### split off metadata
     content = all_text.split("X-FileName:")
     words = ""
     if len(content) > 1:
         ### remove punctuation
-        text_string = content[1].translate(str.maketrans("", "", string.punctuation))
+        text_string = content[1].translate(PUNCTUATION)
 
         ### project part 2: comment out the line below
         # words = text_string
@@ -33,12 +47,8 @@ def parseOutText(f):
         ### split the text string into individual words, stem each word,
         ### and append the stemmed word to words (make sure there's a single
         ### space between each stemmed word)
-        from nltk.stem.snowball import SnowballStemmer
-        
-        stemmer = SnowballStemmer("english")
-        
         text_words = text_string.split()
-        text_words = [stemmer.stem(word) for word in text_words]
+        text_words = [stemWord(word) for word in text_words]
         words = " ".join(text_words)
         
     return words
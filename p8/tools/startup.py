@@ -37,11 +37,20 @@ print ("download complete!")
 
 
 print
-print ("unzipping Enron dataset (this may take a while)")
-import tarfile
-import os
-os.chdir("..")
-tfile = tarfile.open("enron_mail_20150507.tar.gz", "r:gz")
-tfile.extractall(".")
+import sys
+if "--index" in sys.argv:
+    ### no maildir/: the emails are read through enron_archive.EnronArchive
+    print ("indexing Enron dataset (this may take a while)")
+    from enron_archive import buildArchive
+    tar_path, count = buildArchive("../enron_mail_20150507.tar.gz")
+    print (count, "emails indexed in", tar_path)
+else:
+    print ("unzipping Enron dataset (this may take a while)")
+    print ("(run with --index to index the tarball for random access instead)")
+    import tarfile
+    import os
+    os.chdir("..")
+    tfile = tarfile.open("enron_mail_20150507.tar.gz", "r:gz")
+    tfile.extractall(".")
 
 print ("you're ready to go!")